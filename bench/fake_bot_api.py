@@ -0,0 +1,179 @@
+"""Local stand-in for the Telegram Bot API.
+
+Answers the methods bot.py uses with plausible payloads after a configurable
+delay, and can answer a fraction of calls with 429 flood control. Point the
+bot at it with TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot
+
+    python bench/fake_bot_api.py --port 8081 --latency 80 --jitter 40 --flood-rate 0.01
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+class FakeBotAPI:
+    def __init__(self, latency=0.05, jitter=0.0, flood_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.floods = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._invite_ids = itertools.count(1)
+        # Approve button of the latest payment sent to admins, by user id.
+        self.approvals = {}
+
+    def record(self, method, flooded):
+        with self._lock:
+            self.calls[method] += 1
+            if flooded:
+                self.floods[method] += 1
+
+    def _message(self, params, **extra):
+        chat_id = int(params.get("chat_id", 0) or 0)
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        message.update(extra)
+        return message
+
+    def result_for(self, method, params):
+        if method == "getMe":
+            # Real bot ids are the numeric prefix of the token.
+            bot_id = params.get("_token", "").split(":", 1)[0]
+            return dict(BOT_USER, id=int(bot_id)) if bot_id.isdigit() else BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params, text=params.get("text", ""))
+        if method == "sendPhoto":
+            self.record_approval(params.get("reply_markup"))
+            return self._message(params, photo=[{
+                "file_id": params.get("photo", "photo"),
+                "file_unique_id": "u" + str(next(self._message_ids)),
+                "width": 1, "height": 1,
+            }])
+        if method == "sendDocument":
+            return self._message(params, document={"file_id": "doc", "file_unique_id": "doc"})
+        if method in ("createChatInviteLink", "revokeChatInviteLink"):
+            return {
+                "invite_link": params.get("invite_link") or f"https://t.me/+bench{next(self._invite_ids)}",
+                "creator": BOT_USER,
+                "creates_join_request": False,
+                "is_primary": False,
+                "is_revoked": method == "revokeChatInviteLink",
+                "member_limit": int(params.get("member_limit", 1) or 1),
+            }
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        return True
+
+    def handle(self, method, params):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.record(method, True)
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        self.record(method, False)
+        return 200, {"ok": True, "result": self.result_for(method, params)}
+
+    def record_approval(self, reply_markup):
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        for row in (reply_markup or {}).get("inline_keyboard", []):
+            for button in row:
+                data = button.get("callback_data", "")
+                if data.startswith("approve:"):
+                    with self._lock:
+                        self.approvals[int(data.split(":")[1])] = data
+
+    def approval_for(self, user_id):
+        with self._lock:
+            return self.approvals.get(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "floods": dict(self.floods)}
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, api.stats())
+            elif self.path == "/approvals":
+                with api._lock:
+                    self._reply(200, dict(api.approvals))
+            else:
+                self._reply(404, {"ok": False})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length) if length else b""
+            params = {}
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.startswith("application/x-www-form-urlencoded"):
+                params = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+            elif content_type.startswith("application/json") and raw:
+                params = json.loads(raw)
+            token_part, _, method = self.path.rpartition("/")
+            params["_token"] = token_part.rsplit("/bot", 1)[-1]
+            code, payload = api.handle(method, params)
+            self._reply(code, payload)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def serve(api, host="127.0.0.1", port=8081):
+    """Start the fake API on a background thread and return the server."""
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=50, help="base latency in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="extra random latency in ms")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.flood_rate, args.retry_after)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(api))
+    print(f"Fake Bot API listening on http://{args.host}:{args.port}/bot")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(api.stats(), indent=2))
+
+if __name__ == "__main__":
+    main()
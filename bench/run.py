@@ -0,0 +1,212 @@
+"""Drive the bot's /webhook with the synthetic funnel and report latency.
+
+    python bench/run.py --spawn --users 200 --rate 100 --mode queue
+
+--spawn starts the fake Bot API in this process and a gunicorn bot pointing
+at it, on a throwaway database. Without it, pass --url for a bot that is
+already running against bench/fake_bot_api.py (and --api-url for its stats
+and the approve buttons it relayed; without it, approvals use the legacy
+callback format that carries no payment id).
+
+The report covers webhook latency percentiles and throughput, the calls the
+fake API saw (including injected 429s), and the bot's own /metrics for
+handler latency and SQLite writer-lock contention over the run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+from fake_bot_api import FakeBotAPI, serve
+from updates import FUNNEL_STEPS, UpdateFactory
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SAMPLE = re.compile(r"^([a-zA-Z_:][\w:]*)(\{[^}]*\})?\s+(\S+)$")
+
+def parse_metrics(text):
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if match:
+            samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def metric_delta(before, after, name):
+    """Return {labels: (sum_delta, count_delta)} for a histogram."""
+    result = {}
+    for (metric, labels), value in after.items():
+        if metric != f"{name}_count":
+            continue
+        count = value - before.get((metric, labels), 0.0)
+        total = after.get((f"{name}_sum", labels), 0.0) - before.get((f"{name}_sum", labels), 0.0)
+        if count:
+            result[labels] = (total, count)
+    return result
+
+def spawn_bot(args, api_port, workdir):
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:BENCHMARK",
+        PRIVATE_CHANNEL_ID="-1001000000000",
+        ADMIN_IDS=str(args.admin_id),
+        DB_PATH=os.path.join(workdir, "bench.db"),
+        BOT_IDENTITY_CACHE=os.path.join(workdir, "bot_identity.json"),
+        TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{api_port}/bot",
+        PORT=str(args.bot_port),
+        WEBHOOK_MODE=args.mode,
+        WEB_CONCURRENCY=str(args.workers),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "bot:app"],
+        cwd=REPO_ROOT,
+        env=env,
+    )
+
+async def wait_until_up(client, url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(f"{url}/")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.25)
+    raise RuntimeError(f"bot at {url} did not come up within {timeout}s")
+
+async def wait_for_drain(client, url, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = (await client.get(f"{url}/health/queue")).json()
+        if stats["mode"] != "queue" or (stats["depth"] == 0 and stats["processed"] >= stats["enqueued"]):
+            return
+        await asyncio.sleep(0.2)
+
+async def approve_data_for(client, args, api, user_id, timeout=30):
+    """Wait for the admin's approve button for `user_id` and return its data."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if api is not None:
+            data = api.approval_for(user_id)
+        else:
+            data = (await client.get(f"{args.api_url}/approvals")).json().get(str(user_id))
+        if data:
+            return data
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"no payment reached the admin for user {user_id} within {timeout}s")
+
+async def drive(args, api=None):
+    latencies = defaultdict(list)
+    statuses = Counter()
+    factory = UpdateFactory(admin_id=args.admin_id)
+    plan = list(factory.funnel(args.users, args.steps))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        await wait_until_up(client, args.url)
+        before = parse_metrics((await client.get(f"{args.url}/metrics")).text)
+
+        async def post(step, user_id, months):
+            approve_data = None
+            if step == "approve" and (api is not None or args.api_url):
+                approve_data = await approve_data_for(client, args, api, user_id)
+            update = factory.step(user_id, step, months, approve_data)
+            started = time.perf_counter()
+            try:
+                response = await client.post(f"{args.url}/webhook", json=update)
+                statuses[response.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+            latencies[step].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        tasks = []
+        for i, (step, user_id, months) in enumerate(plan):
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(step, user_id, months)))
+        await asyncio.gather(*tasks)
+        sent_in = time.perf_counter() - started
+        await wait_for_drain(client, args.url)
+        drained_in = time.perf_counter() - started
+        after = parse_metrics((await client.get(f"{args.url}/metrics")).text)
+    return plan, latencies, statuses, sent_in, drained_in, before, after
+
+def report(plan, latencies, statuses, sent_in, drained_in, before, after, api_stats):
+    everything = [v for values in latencies.values() for v in values]
+    print(f"\nSent {len(plan)} updates in {sent_in:.2f}s "
+          f"({len(plan) / sent_in:.1f}/s); all work drained after {drained_in:.2f}s "
+          f"({len(plan) / drained_in:.1f} updates/s end to end)")
+    print(f"Webhook status codes: {dict(statuses)}")
+    print(f"\n{'step':<10}{'n':>7}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step in list(latencies) + ["all"]:
+        values = everything if step == "all" else latencies[step]
+        print(f"{step:<10}{len(values):>7}{percentile(values, 50) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{max(values, default=0) * 1000:>10.1f}")
+
+    print("\nHandler latency (mean ms, from /metrics):")
+    for labels, (total, count) in sorted(metric_delta(before, after, "bot_handler_duration_seconds").items()):
+        print(f"  {labels:<32}{total / count * 1000:>10.1f}  x{int(count)}")
+    print("Bot API latency (mean ms, from /metrics):")
+    for labels, (total, count) in sorted(metric_delta(before, after, "bot_api_request_duration_seconds").items()):
+        print(f"  {labels:<32}{total / count * 1000:>10.1f}  x{int(count)}")
+    for name in ("bot_db_lock_wait_seconds", "bot_db_lock_hold_seconds"):
+        for _, (total, count) in metric_delta(before, after, name).items():
+            print(f"DB contention {name}: {int(count)} transactions, mean {total / count * 1000:.2f} ms")
+    if api_stats is not None:
+        print(f"\nFake Bot API: {json.dumps(api_stats)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook load test against a fake Bot API.")
+    parser.add_argument("--url", default=None, help="bot base URL (default: spawned bot)")
+    parser.add_argument("--api-url", default=None, help="fake API base URL, for /stats and /approvals")
+    parser.add_argument("--spawn", action="store_true", help="start the fake API and a gunicorn bot")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=50, help="target webhook POSTs per second")
+    parser.add_argument("--concurrency", type=int, default=200, help="max open connections")
+    parser.add_argument("--steps", nargs="+", default=list(FUNNEL_STEPS), choices=FUNNEL_STEPS)
+    parser.add_argument("--admin-id", type=int, default=1)
+    parser.add_argument("--mode", default="queue", choices=("sync", "queue"))
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers for --spawn")
+    parser.add_argument("--bot-port", type=int, default=18080)
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--latency", type=float, default=50, help="fake API latency in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="fake API jitter in ms")
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    api, bot = None, None
+    workdir = tempfile.mkdtemp(prefix="botbench-")
+    if args.spawn:
+        api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.flood_rate)
+        serve(api, port=args.api_port)
+        bot = spawn_bot(args, args.api_port, workdir)
+        args.url = f"http://127.0.0.1:{args.bot_port}"
+    elif not args.url:
+        parser.error("pass --url or --spawn")
+    try:
+        results = asyncio.run(drive(args, api))
+    finally:
+        if bot is not None:
+            bot.terminate()
+            bot.wait(timeout=30)
+    api_stats = api.stats() if api else None
+    if api_stats is None and args.api_url:
+        api_stats = httpx.get(f"{args.api_url}/stats").json()
+    report(*results, api_stats)
+
+if __name__ == "__main__":
+    main()
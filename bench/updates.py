@@ -0,0 +1,91 @@
+"""Synthetic Telegram Update payloads for the full payment funnel.
+
+Each user walks /start -> proceed -> plan -> photo, and an admin then taps
+approve. Steps are emitted round by round, so each user's steps stay in order
+and are spaced out by one full round.
+
+The approve button carries the payment id the bot assigned, so the driver
+passes in the callback data the admin actually received (see
+FakeBotAPI.approvals).
+"""
+import itertools
+import time
+
+FUNNEL_STEPS = ("start", "proceed", "plan", "photo", "approve")
+
+class UpdateFactory:
+    def __init__(self, first_user_id=700000000, admin_id=1, first_update_id=1):
+        self.first_user_id = first_user_id
+        self.admin_id = admin_id
+        self._update_ids = itertools.count(first_update_id)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    @staticmethod
+    def _chat(user_id):
+        return {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+
+    def _message(self, user_id, **fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(user_id),
+            "from": self._user(user_id),
+        }
+        message.update(fields)
+        return message
+
+    def _wrap(self, **fields):
+        return {"update_id": next(self._update_ids), **fields}
+
+    def command(self, user_id, command):
+        text = f"/{command}"
+        return self._wrap(message=self._message(
+            user_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(text)}]
+        ))
+
+    def callback(self, from_id, data):
+        return self._wrap(callback_query={
+            "id": str(next(self._callback_ids)),
+            "from": self._user(from_id),
+            "chat_instance": str(from_id),
+            "data": data,
+            "message": self._message(from_id, text="…"),
+        })
+
+    def photo(self, user_id):
+        file_unique_id = f"bench{user_id}"
+        return self._wrap(message=self._message(user_id, photo=[{
+            "file_id": f"file-{file_unique_id}",
+            "file_unique_id": file_unique_id,
+            "width": 720,
+            "height": 1280,
+        }]))
+
+    def step(self, user_id, step, months=1, approve_data=None):
+        if step == "start":
+            return self.command(user_id, "start")
+        if step == "proceed":
+            return self.callback(user_id, "proceed")
+        if step == "plan":
+            return self.callback(user_id, f"plan:{months}")
+        if step == "photo":
+            return self.photo(user_id)
+        if step == "approve":
+            return self.callback(self.admin_id, approve_data or f"approve:{user_id}:{months}")
+        raise ValueError(step)
+
+    def funnel(self, users, steps=FUNNEL_STEPS):
+        """Yield (step, user_id, months) for `users` users walking through `steps`.
+
+        Updates are built with step() at send time, once the approve button's
+        payment id is known.
+        """
+        user_ids = range(self.first_user_id, self.first_user_id + users)
+        for step in steps:
+            for user_id in user_ids:
+                yield step, user_id, user_id % 3 + 1
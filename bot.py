@@ -1,23 +1,112 @@
 import os
-import sqlite3
+import re
+import io
+import csv
+import json
+import tempfile
 import threading
 import time
 import asyncio
+import heapq
+import functools
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from flask import Flask, request
+from flask import Flask, request, jsonify, Response
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, User, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import NetworkError, Forbidden, BadRequest, TimedOut, RetryAfter
 from telegram.ext import (
     Application,
+    ExtBot,
     CommandHandler,
     MessageHandler,
     filters,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
 )
+from storage import (
+    init_db,
+    add_subscription,
+    record_payment,
+    discard_payment,
+    record_daily_stats,
+    get_stats,
+    stats_day,
+    get_payment_status,
+    claim_payment_delivery,
+    release_payment_delivery,
+    mark_payment_delivered,
+    approve_payment,
+    decline_payment,
+    add_subscriptions,
+    import_subscriptions,
+    export_subscriptions_csv,
+    get_subscription_expiry_cached,
+    expiry_cache_stats,
+    expiry_cache_size,
+    get_subscriptions_expiring_before,
+    get_expired_among,
+    remove_expired_subscriptions,
+    list_subscriptions_page,
+    subscription_listeners,
+    acquire_leader_lock,
+    add_invite_links,
+    claim_invite_link,
+    record_issued_invite_link,
+    count_invite_stock,
+    mark_invite_link_joined,
+    get_invite_links_to_revoke,
+    mark_invite_links_revoked,
+    create_broadcast,
+    get_running_broadcasts,
+    get_recent_broadcasts,
+    get_broadcast_status,
+    get_broadcast_recipients,
+    save_broadcast_progress,
+    finish_broadcast,
+    get_reminder_candidates,
+    record_reminders,
+    prune_reminders,
+    run_db,
+)
+from ratelimit import TokenBucket, ChatPacer, call_with_retry
+from botapi import BotAPIRequest
+import templates
+from templates import user_language
+from logs import setup_logging, bind_log_context, reset_log_context, elapsed_ms
+from persistence import SQLitePersistence
+from metrics import (
+    Gauge,
+    CounterFunc,
+    render_metrics,
+    handler_latency,
+    handler_errors,
+    webhook_requests,
+    cleanup_duration,
+)
+
+# -------------------- Startup Timing --------------------
+# Import only wires things up; the DB schema, Bot API handshake and
+# background jobs are brought up on the bot loop once gunicorn is serving, so
+# Telegram's first webhook after a cold start gets an answer quickly.
+STARTUP_STARTED = time.perf_counter()
+startup_timings = {}
+
+@contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round(time.perf_counter() - started, 4)
 
 # -------------------- Load Environment Variables --------------------
 load_dotenv()
+setup_logging()
+log = logging.getLogger("bot")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 PRIVATE_CHANNEL_ID = os.getenv("PRIVATE_CHANNEL_ID")
@@ -37,130 +126,128 @@ if not BOT_TOKEN:
 if not PRIVATE_CHANNEL_ID:
     raise RuntimeError("PRIVATE_CHANNEL_ID is required")
 
-# -------------------- Database Setup --------------------
-DB_PATH = "subscriptions.db"
-db_lock = threading.Lock()
-
-def init_db():
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS subscriptions (
-                        user_id INTEGER PRIMARY KEY,
-                        expiry_date INTEGER NOT NULL)''')
-        conn.commit()
-        conn.close()
-
-def add_subscription(user_id, days):
-    expiry = int(time.time()) + days * 86400
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("REPLACE INTO subscriptions (user_id, expiry_date) VALUES (?, ?)", (user_id, expiry))
-        conn.commit()
-        conn.close()
-
-def remove_subscription(user_id):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
-
-def get_expired_users(now=None):
-    if now is None:
-        now = int(time.time())
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM subscriptions WHERE expiry_date <= ?", (now,))
-        expired = [row[0] for row in c.fetchall()]
-        conn.close()
-    return expired
-
-def get_subscription_expiry(user_id):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT expiry_date FROM subscriptions WHERE user_id = ?", (user_id,))
-        row = c.fetchone()
-        conn.close()
-        return row[0] if row else None
-
-init_db()
-
 # -------------------- Flask App --------------------
 app = Flask(__name__)
 
 # -------------------- Bot Setup --------------------
-application = Application.builder().token(BOT_TOKEN).build()
+# Overridable so load tests can point the bot at bench/fake_bot_api.py.
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
 
-# -------------------- Premium Constants --------------------
-TELEBIRR_ACCOUNT = "0987973732"
-PRICE_1 = 700
-PRICE_2 = 1400
-PRICE_3 = 2000
+# user_data lives in the shared database so the plan chosen in one gunicorn
+# worker is still there when the payment screenshot reaches another.
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "1"))
+PERSISTENCE_SYNC_INTERVAL = float(os.getenv("PERSISTENCE_SYNC_INTERVAL", "1"))
+
+# initialize() calls getMe, which costs a Bot API round trip on every cold
+# start. The bot's identity doesn't change, so it is kept on disk and the
+# real getMe runs in the background once the bot is serving.
+BOT_IDENTITY_CACHE = os.getenv("BOT_IDENTITY_CACHE", "bot_identity.json")
+
+def load_cached_identity():
+    try:
+        with open(BOT_IDENTITY_CACHE) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if str(data.get("id")) != BOT_TOKEN.split(":", 1)[0]:
+        return None
+    return data
+
+def save_cached_identity(user):
+    try:
+        with open(BOT_IDENTITY_CACHE, "w") as f:
+            json.dump(user.to_dict(), f)
+    except OSError as e:
+        log.warning("Could not cache bot identity: %s", e)
+
+class CachedIdentityBot(ExtBot):
+    """ExtBot whose first getMe is answered from the on-disk identity cache."""
+
+    async def get_me(self, *args, **kwargs):
+        if self._bot_user is None:
+            cached = load_cached_identity()
+            if cached is not None:
+                self._bot_user = User.de_json(cached, self)
+                return self._bot_user
+        user = await super().get_me(*args, **kwargs)
+        save_cached_identity(user)
+        return user
+
+# Telegram allows roughly 30 messages per second overall and one per second
+# to the same chat. Bulk jobs share these limiters so they stay under both.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+api_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+chat_pacer = ChatPacer(TELEGRAM_CHAT_INTERVAL)
+
+with startup_phase("build_application"):
+    persistence = SQLitePersistence(
+        update_interval=PERSISTENCE_UPDATE_INTERVAL,
+        sync_interval=PERSISTENCE_SYNC_INTERVAL,
+    )
+    bot = CachedIdentityBot(
+        token=BOT_TOKEN,
+        base_url=TELEGRAM_API_BASE_URL,
+        # A 429 on any call also pauses the bucket the bulk jobs draw from.
+        request=BotAPIRequest(on_flood=api_bucket.pause),
+    )
+    application = Application.builder().bot(bot).persistence(persistence).build()
+
+# -------------------- Admin Fan-out --------------------
+ADMIN_FANOUT_CONCURRENCY = int(os.getenv("ADMIN_FANOUT_CONCURRENCY", "10"))
+ADMIN_FANOUT_ATTEMPTS = int(os.getenv("ADMIN_FANOUT_ATTEMPTS", "3"))
+
+async def fan_out_to_admins(send, **kwargs):
+    """Call send(chat_id=admin_id, **kwargs) for every admin concurrently.
+
+    Transient network errors and flood control are retried. Returns a dict
+    mapping each admin id to the sent message or the exception it ended with.
+    """
+    semaphore = asyncio.Semaphore(ADMIN_FANOUT_CONCURRENCY)
+
+    async def deliver(admin_id):
+        async with semaphore:
+            try:
+                return await call_with_retry(
+                    send,
+                    chat_id=admin_id,
+                    bucket=api_bucket,
+                    attempts=ADMIN_FANOUT_ATTEMPTS,
+                    retry_on=(NetworkError,),
+                    **kwargs,
+                )
+            except Exception as e:
+                log.warning("Failed to send to admin %s: %s", admin_id, e)
+                return e
 
+    results = await asyncio.gather(*(deliver(admin_id) for admin_id in ADMIN_IDS))
+    return dict(zip(ADMIN_IDS, results))
+
+# -------------------- Premium Constants --------------------
+# Plans, prices and the funnel screens live in templates.py.
 def format_expiry(timestamp):
     if not timestamp:
         return "`Not subscribed`"
     dt = datetime.fromtimestamp(timestamp)
     return f"`{dt.strftime('%Y-%m-%d %H:%M:%S')}`"
 
-def plan_keyboard():
-    keyboard = [
-        [InlineKeyboardButton(f"💎 1 Month – {PRICE_1} Birr", callback_data="plan:1")],
-        [InlineKeyboardButton(f"✨ 2 Months – {PRICE_2} Birr", callback_data="plan:2")],
-        [InlineKeyboardButton(f"🔥 3 Months – {PRICE_3} Birr", callback_data="plan:3")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def proceed_keyboard():
-    keyboard = [[InlineKeyboardButton("💳 Proceed to Membership", callback_data="proceed")]]
-    return InlineKeyboardMarkup(keyboard)
-
 # -------------------- Premium Welcome Message --------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome_text = (
-        "╔══════════════════════════════╗\n"
-        "     👑🔥 **VVIP HABESHA** 🔥👑     \n"
-        "╚══════════════════════════════╝\n\n"
-        "✨ *Welcome to the most exclusive Habesha premium channel!* ✨\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        "🇺🇸 **What you'll enjoy:**\n"
-        "• 🔥 Exclusive hot videos & photos\n"
-        "• 📅 Daily premium content updates\n"
-        "• 🎥🔴 Live streaming every night\n"
-        "• 💃🏾 Sexy live performances\n"
-        "• 💬 Direct interaction with the community\n"
-        "• 🕒 24/7 VIP support\n\n"
-        "🇪🇹 **ምን ያገኛሉ:**\n"
-        "• 🔥 ልዩ ሙቅ ቪዲዮዎች እና ፎቶዎች\n"
-        "• 📅 ዕለታዊ አዲስ ፕሪሚየም ኮንቴንት\n"
-        "• 🔴 በየምሽቱ ቀጥታ ስርጭት\n"
-        "• 💃🏾 ሴክሲ የቀጥታ ትዕይንቶች\n"
-        "• 💬 ቀጥተኛ ውይይት በፕራይቬት ቻናል\n"
-        "• 🕒 24/7 ድጋፍ\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "👇 *Choose your membership plan below* 👇"
+    funnel = templates.current
+    lang = user_language(update.effective_user)
+    await update.message.reply_text(
+        funnel.welcome[lang], parse_mode="Markdown", reply_markup=funnel.proceed_keyboard[lang]
     )
-    await update.message.reply_text(welcome_text, parse_mode="Markdown", reply_markup=proceed_keyboard())
 
 # -------------------- Premium Proceed Callback --------------------
 async def proceed_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    text = (
-        "🌟 **Select your VIP plan** 🌟\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        "💎 **1 Month** – Full access for 30 days\n"
-        "✨ **2 Months** – Save more with longer access\n"
-        "🔥 **3 Months** – Best value, ultimate experience\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "Tap a button below to continue:"
+    funnel = templates.current
+    lang = user_language(update.effective_user)
+    await query.edit_message_text(
+        funnel.plans_text[lang], parse_mode="Markdown", reply_markup=funnel.plan_keyboard[lang]
     )
-    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=plan_keyboard())
 
 # -------------------- Premium Plan Selection --------------------
 async def plan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -170,37 +257,75 @@ async def plan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data[0] != "plan":
         return
     months = int(data[1])
+    funnel = templates.current
+    lang = user_language(update.effective_user)
+    # The button may predate a price change that removed this plan.
+    if months not in funnel.prices:
+        await query.edit_message_text(
+            funnel.plans_text[lang], parse_mode="Markdown", reply_markup=funnel.plan_keyboard[lang]
+        )
+        return
     context.user_data['selected_months'] = months
-    price = {1: PRICE_1, 2: PRICE_2, 3: PRICE_3}[months]
-
-    text = (
-        f"✅ **You selected {months} month(s)**\n"
-        f"💵 **Total: {price} Birr**\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"🇺🇸 *Please send exactly **{price} Birr** to the following Telebirr account:*\n"
-        f"`{TELEBIRR_ACCOUNT}`\n\n"
-        "📸 *After payment, send a screenshot of the transaction.*\n\n"
-        f"🇪🇹 *እባክዎ በትክክል **{price} ብር** ወደዚህ ቴሌብር አካውንት ይላኩ።*\n"
-        f"`{TELEBIRR_ACCOUNT}`\n\n"
-        "*ከክፍያ በኋላ የስክሪን ሾት ይላኩ።*\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
-    )
-    await query.edit_message_text(text, parse_mode="Markdown")
+    await query.edit_message_text(funnel.payment_text[months, lang], parse_mode="Markdown")
 
 # -------------------- Premium Photo Handler --------------------
+# Replies for a screenshot that was already submitted, by payment state.
+DUPLICATE_PAYMENT_REPLIES = {
+    "pending": (
+        "⏳ **This screenshot was already sent and is waiting for review.**\n\n"
+        "⏳ ይህ የስክሪን ሾት ቀደም ብሎ ተልኳል፣ በመገምገም ላይ ነው።"
+    ),
+    "approved": (
+        "⚠️ **This screenshot was already used for an approved payment.**\n\n"
+        "⚠️ ይህ የስክሪን ሾት ለጸደቀ ክፍያ ጥቅም ላይ ውሏል።"
+    ),
+    "declined": (
+        "❌ **This screenshot was declined.** Please send a new payment proof.\n\n"
+        "❌ ይህ የስክሪን ሾት ውድቅ ተደርጓል። እባክዎ አዲስ የክፍያ ማረጋገጫ ይላኩ።"
+    ),
+}
+
+PAYMENT_NOT_FORWARDED = (
+    "⚠️ **We couldn't reach the admins with your payment proof.** "
+    "Please send the screenshot again in a few minutes.\n\n"
+    "⚠️ የክፍያ ማረጋገጫዎን ለአስተዳዳሪዎች ማድረስ አልቻልንም። እባክዎ ከጥቂት ደቂቃዎች በኋላ የስክሪን ሾቱን እንደገና ይላኩ።"
+)
+
+async def forward_payment_to_admins(bot, payment_id, user_id, months, user_data, **kwargs):
+    """Send a new payment to every admin.
+
+    If none of them got it, the payment is dropped and the user is asked to
+    resend, instead of the screenshot staying pending with nobody to review it.
+    """
+    results = await fan_out_to_admins(bot.send_photo, **kwargs)
+    if any(not isinstance(result, Exception) for result in results.values()):
+        return
+    if not await run_db(discard_payment, payment_id):
+        return
+    log.error("No admin received payment #%d, asking user %d to resend", payment_id, user_id)
+    user_data['selected_months'] = months
+    await bot.send_message(chat_id=user_id, text=PAYMENT_NOT_FORWARDED, parse_mode="Markdown")
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
+    funnel = templates.current
     months = context.user_data.get('selected_months')
-    if not months:
+    price = funnel.prices.get(months)
+    if price is None:
+        lang = user_language(user)
         await update.message.reply_text(
-            "⚠️ Please first choose a subscription plan using /start.\n\n"
-            "👉 Tap the button below to begin.",
-            reply_markup=proceed_keyboard()
+            funnel.choose_plan_first[lang], reply_markup=funnel.proceed_keyboard[lang]
         )
         return
 
-    price = {1: PRICE_1, 2: PRICE_2, 3: PRICE_3}[months]
     photo = update.message.photo[-1]
+    # Resent screenshots are caught here, before any admin is bothered.
+    payment_id, state = await run_db(
+        record_payment, photo.file_unique_id, user.id, months, price, int(time.time())
+    )
+    if state is not None:
+        await update.message.reply_text(DUPLICATE_PAYMENT_REPLIES[state], parse_mode="Markdown")
+        return
     caption = (
         "╔════════════════════════╗\n"
         "   💳 **NEW PAYMENT** 💳   \n"
@@ -210,29 +335,36 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📛 *Username:* @{user.username or 'N/A'}\n"
         f"📅 *Plan:* {months} month(s)\n"
         f"💰 *Amount:* {price} Birr\n"
-        f"🏦 *Telebirr:* `{TELEBIRR_ACCOUNT}`\n"
+        f"🏦 *Telebirr:* `{funnel.account}`\n"
+        f"🧾 *Payment:* #{payment_id}\n"
         "━━━━━━━━━━━━━━━━━━━━━━━━\n"
         "👇 *Approve or decline below* 👇"
     )
     keyboard = [
         [
-            InlineKeyboardButton(f"✅ Approve ({months} months)", callback_data=f"approve:{user.id}:{months}"),
-            InlineKeyboardButton("❌ Decline", callback_data=f"decline:{user.id}")
+            InlineKeyboardButton(f"✅ Approve ({months} months)", callback_data=f"approve:{user.id}:{months}:{payment_id}"),
+            InlineKeyboardButton("❌ Decline", callback_data=f"decline:{user.id}:{payment_id}")
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_photo(
-                chat_id=admin_id,
-                photo=photo.file_id,
-                caption=caption,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            print(f"Failed to send to admin {admin_id}: {e}")
+    context.user_data.clear()
+    # Admins are notified in the background so the user's reply isn't held
+    # up by one Telegram round trip per admin.
+    context.application.create_task(
+        forward_payment_to_admins(
+            context.bot,
+            payment_id,
+            user.id,
+            months,
+            context.user_data,
+            photo=photo.file_id,
+            caption=caption,
+            reply_markup=reply_markup,
+            parse_mode="Markdown"
+        ),
+        update=update,
+    )
 
     await update.message.reply_text(
         "✅ **Your payment proof has been forwarded to our admins.**\n"
@@ -240,29 +372,59 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "✅ **የክፍያ ማረጋገጫዎ ለአስተዳዳሪዎቻችን ተልኳል።**\n"
         "⏳ ሲፀድቅ ይነገርዎታል።"
     )
-    context.user_data.clear()
 
 # -------------------- Premium Callback Handler --------------------
+# An approval's invite delivery is claimed in the payments row, so a second
+# click while the first is still sending doesn't send another link. A claim
+# older than this is treated as abandoned.
+PAYMENT_DELIVERY_CLAIM_TTL = int(os.getenv("PAYMENT_DELIVERY_CLAIM_TTL", "120"))
+
+async def answer_already_decided(query, payment_id, state):
+    await query.answer(f"Payment #{payment_id} was already {state}.", show_alert=True)
+
+async def edit_admin_message(query, text, **kwargs):
+    """Edit the admin's copy of a payment, which is a photo with a caption."""
+    if query.message and query.message.photo:
+        await query.edit_message_caption(caption=text, **kwargs)
+    else:
+        await query.edit_message_text(text, **kwargs)
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     if query.from_user.id not in ADMIN_IDS:
+        await query.answer()
         await query.edit_message_text("⛔ Unauthorized.")
         return
 
+    # approve:{user}:{months}:{payment} / decline:{user}:{payment}. Buttons
+    # sent before payments were recorded carry no payment id.
     data = query.data.split(":")
     action = data[0]
     user_id = int(data[1])
 
     if action == "approve":
         months = int(data[2])
-        add_subscription(user_id, months * 30)
+        payment_id = int(data[3]) if len(data) > 3 else None
+        if payment_id is not None:
+            now = int(time.time())
+            approved = await run_db(approve_payment, payment_id, query.from_user.id, now)
+            # An approval whose invite link never reached the user can be
+            # clicked again: the link is resent, the period isn't extended.
+            if approved is None and not await run_db(
+                claim_payment_delivery, payment_id, now, now - PAYMENT_DELIVERY_CLAIM_TTL
+            ):
+                state, delivered_at = await run_db(get_payment_status, payment_id)
+                if state == "approved" and delivered_at is None:
+                    await query.answer(f"The invite link for payment #{payment_id} is being sent.")
+                else:
+                    await answer_already_decided(query, payment_id, state)
+                return
+        else:
+            await run_db(add_subscription, user_id, months * 30)
+            await run_db(record_daily_stats, int(time.time()), {"approvals": 1})
+        await query.answer()
         try:
-            invite_link = await context.bot.create_chat_invite_link(
-                chat_id=PRIVATE_CHANNEL_ID,
-                member_limit=1,
-                expire_date=int(time.time()) + months * 30 * 86400
-            )
+            invite_link = await get_invite_link(user_id)
             await context.bot.send_message(
                 chat_id=user_id,
                 text=(
@@ -270,22 +432,41 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "   🎉 **PAYMENT APPROVED!** 🎉   \n"
                     "╚══════════════════════════════════╝\n\n"
                     f"✨ **You have been granted access for {months} month(s).** ✨\n\n"
-                    f"🔗 **Your exclusive invite link:**\n{invite_link.invite_link}\n\n"
+                    f"🔗 **Your exclusive invite link:**\n{invite_link}\n\n"
                     "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-                    "⚠️ *This link expires in {months} months and can only be used once.*\n\n"
+                    f"⚠️ *This link can only be used once and expires in {INVITE_LINK_ISSUED_TTL // 3600} hours.*\n\n"
                     "🇪🇹 ክፍያዎ ጸድቋል! የመግቢያ ሊንክዎ ከላይ አለ።\n"
                     "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
                 ),
                 parse_mode="Markdown"
             )
-            await query.edit_message_text(
-                text=f"✅ **Approved user `{user_id}` for {months} months.**\n\n📨 Invite link sent.",
+            if payment_id is not None:
+                await run_db(mark_payment_delivered, payment_id, int(time.time()))
+            await edit_admin_message(
+                query,
+                f"✅ **Approved user `{user_id}` for {months} months.**\n\n📨 Invite link sent.",
                 parse_mode="Markdown"
             )
         except Exception as e:
-            await query.edit_message_text(f"❌ Approval failed: {e}")
+            # Keep the buttons so the approval can be retried.
+            if payment_id is not None:
+                await run_db(release_payment_delivery, payment_id)
+            await edit_admin_message(
+                query,
+                f"❌ Invite delivery failed: {e}\n\nTap Approve again to resend the link.",
+                reply_markup=query.message.reply_markup if query.message else None,
+            )
     elif action == "decline":
-        await query.edit_message_text(f"❌ **Declined user `{user_id}`.**", parse_mode="Markdown")
+        if len(data) > 2:
+            payment_id = int(data[2])
+            if not await run_db(decline_payment, payment_id, query.from_user.id, int(time.time())):
+                state, _ = await run_db(get_payment_status, payment_id)
+                await answer_already_decided(query, payment_id, state)
+                return
+        else:
+            await run_db(record_daily_stats, int(time.time()), {"declines": 1})
+        await query.answer()
+        await edit_admin_message(query, f"❌ **Declined user `{user_id}`.**", parse_mode="Markdown")
 
 # -------------------- Other Handlers (Help, Status, Renew, Approve, List) --------------------
 # (These remain largely the same but with enhanced formatting)
@@ -300,14 +481,22 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/renew – 🔄 Request renewal\n\n"
         "👑 **For admins only:**\n"
         "/approve `<user_id>` [months] – ✅ Manually approve (default 1 month)\n"
-        "/list – 📋 List all active subscribers\n"
+        "/approve `<id>,<id>,...` [months] – ✅ Approve many users at once\n"
+        "/list [all|active|expired|soon] – 📋 Browse subscribers\n"
+        "/export – 📤 Download all subscriptions as CSV\n"
+        "/broadcast [all] `<text>` – 📣 Message active (or all) subscribers\n"
+        "/broadcast – 📊 Show recent broadcasts\n"
+        "/broadcast cancel `<id>` – 🛑 Stop a running broadcast\n"
+        "/reload – 🔄 Reload plans and prices\n"
+        "/stats [days] – 📊 Subscribers, revenue, approvals and churn\n"
+        "📎 Send a `.csv` with `user_id` and `expiry_date`, `days` or `months` columns to import\n"
         "━━━━━━━━━━━━━━━━━━━━━━━━━"
     )
     await update.message.reply_text(help_text, parse_mode="Markdown")
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    expiry = get_subscription_expiry(user_id)
+    expiry = await run_db(get_subscription_expiry_cached, user_id)
     if expiry and expiry > int(time.time()):
         remaining = expiry - int(time.time())
         days = remaining // 86400
@@ -338,22 +527,21 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def renew_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=(
-                    "🔄 **Renewal Request**\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-                    f"👤 *From:* [{user.first_name}](tg://user?id={user.id})\n"
-                    f"🆔 *User ID:* `{user.id}`\n"
-                    f"📛 *Username:* @{user.username or 'N/A'}\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━━━━"
-                ),
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            print(f"Failed to notify admin {admin_id}: {e}")
+    context.application.create_task(
+        fan_out_to_admins(
+            context.bot.send_message,
+            text=(
+                "🔄 **Renewal Request**\n"
+                "━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+                f"👤 *From:* [{user.first_name}](tg://user?id={user.id})\n"
+                f"🆔 *User ID:* `{user.id}`\n"
+                f"📛 *Username:* @{user.username or 'N/A'}\n"
+                "━━━━━━━━━━━━━━━━━━━━━━━━━"
+            ),
+            parse_mode="Markdown"
+        ),
+        update=update,
+    )
     await update.message.reply_text(
         "📩 **Your renewal request has been sent to the admins.**\n\n"
         "📩 **የእድሳት ጥያቄዎ ለአስተዳዳሪዎች ተልኳል።**"
@@ -363,138 +551,1043 @@ async def approve_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("⛔ Unauthorized.")
         return
-    if len(context.args) < 1:
-        await update.message.reply_text("Usage: /approve <user_id> [months]")
+    usage = "Usage: /approve <user_id>[,<user_id>...] [months]"
+    # "/approve 1, 2,3 2" -> ["1,2,3", "2"]. "/approve 5 6 7" is rejected
+    # rather than read as user 5 for 6 months with the 7 dropped.
+    tokens = re.sub(r"\s*,\s*", ",", " ".join(context.args)).split()
+    if not 1 <= len(tokens) <= 2:
+        await update.message.reply_text(usage)
         return
     try:
-        user_id = int(context.args[0])
-        months = int(context.args[1]) if len(context.args) > 1 else 1
+        user_ids = list(dict.fromkeys(int(x) for x in tokens[0].split(",") if x))
+        months = int(tokens[1]) if len(tokens) > 1 else 1
     except ValueError:
         await update.message.reply_text("Invalid arguments.")
         return
+    if not user_ids:
+        await update.message.reply_text(usage)
+        return
+    if len(user_ids) > 1:
+        await approve_many(update, context, user_ids, months)
+        return
+    user_id = user_ids[0]
 
-    add_subscription(user_id, months * 30)
+    await run_db(add_subscription, user_id, months * 30)
     try:
-        invite_link = await context.bot.create_chat_invite_link(
-            chat_id=PRIVATE_CHANNEL_ID,
-            member_limit=1,
-            expire_date=int(time.time()) + months * 30 * 86400
-        )
-        await context.bot.send_message(
+        await deliver_invite(context.bot, user_id, months)
+        await update.message.reply_text(f"✅ **Approved user `{user_id}` for {months} months.**", parse_mode="Markdown")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Approval failed: {e}")
+
+# -------------------- Bulk Approval, Import and Export --------------------
+BULK_APPROVE_CONCURRENCY = int(os.getenv("BULK_APPROVE_CONCURRENCY", "20"))
+
+async def deliver_invite(bot, user_id, months, semaphore=None):
+    """Send a manually approved user their invite link, paced like other bulk sends."""
+    async with semaphore or nullcontext():
+        invite_link = await get_invite_link(user_id)
+        await chat_pacer.wait(user_id)
+        await call_with_retry(
+            bot.send_message,
             chat_id=user_id,
             text=(
                 "╔══════════════════════════════════╗\n"
                 "   🎉 **MANUAL APPROVAL** 🎉   \n"
                 "╚══════════════════════════════════╝\n\n"
                 f"✨ **An admin has granted you access for {months} month(s).** ✨\n\n"
-                f"🔗 **Your exclusive invite link:**\n{invite_link.invite_link}\n\n"
+                f"🔗 **Your exclusive invite link:**\n{invite_link}\n\n"
                 "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
             ),
-            parse_mode="Markdown"
+            parse_mode="Markdown",
+            bucket=api_bucket,
         )
-        await update.message.reply_text(f"✅ **Approved user `{user_id}` for {months} months.**", parse_mode="Markdown")
-    except Exception as e:
-        await update.message.reply_text(f"❌ Approval failed: {e}")
 
-async def list_subscribers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def approve_many(update: Update, context: ContextTypes.DEFAULT_TYPE, user_ids, months):
+    """Grant access to many users in one transaction, then send their links concurrently."""
+    await run_db(add_subscriptions, [(user_id, months * 30) for user_id in user_ids])
+    await update.message.reply_text(
+        f"⏳ Approved {len(user_ids)} users for {months} months. Sending invite links..."
+    )
+    semaphore = asyncio.Semaphore(BULK_APPROVE_CONCURRENCY)
+    results = await asyncio.gather(
+        *(deliver_invite(context.bot, user_id, months, semaphore) for user_id in user_ids),
+        return_exceptions=True,
+    )
+    failed = [user_id for user_id, result in zip(user_ids, results) if isinstance(result, Exception)]
+    text = f"✅ **Invite links sent to {len(user_ids) - len(failed)}/{len(user_ids)} users.**"
+    if failed:
+        text += "\n❌ Failed: " + ", ".join(f"`{user_id}`" for user_id in failed[:50])
+        if len(failed) > 50:
+            text += f" and {len(failed) - 50} more"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+def parse_subscriptions_csv(data):
+    """Parse an uploaded CSV into (user_id, expiry_date) rows.
+
+    Needs a user_id column plus one of expiry_date (unix time), days or
+    months. Returns (rows, skipped_line_numbers).
+    """
+    now = int(time.time())
+    reader = csv.DictReader(io.StringIO(data.decode("utf-8-sig")))
+    rows, skipped = [], []
+    for line, record in enumerate(reader, start=2):
+        try:
+            user_id = int(record["user_id"])
+            if record.get("expiry_date"):
+                expiry = int(float(record["expiry_date"]))
+            elif record.get("days"):
+                expiry = now + int(record["days"]) * 86400
+            else:
+                expiry = now + int(record["months"]) * 30 * 86400
+        except (KeyError, TypeError, ValueError):
+            skipped.append(line)
+            continue
+        rows.append((user_id, expiry))
+    return rows, skipped
+
+async def import_subscriptions_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    document = update.message.document
+    data = await (await document.get_file()).download_as_bytearray()
+    try:
+        rows, skipped = parse_subscriptions_csv(bytes(data))
+    except (UnicodeDecodeError, csv.Error) as e:
+        await update.message.reply_text(f"❌ Could not read {document.file_name}: {e}")
+        return
+    if rows:
+        await run_db(import_subscriptions, rows)
+    text = f"📥 **Imported {len(rows)} subscriptions from** `{document.file_name}`."
+    if skipped:
+        text += f"\n⚠️ Skipped {len(skipped)} invalid rows (lines {', '.join(map(str, skipped[:20]))}"
+        text += "...)" if len(skipped) > 20 else ")"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+def _write_export(fileobj):
+    text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="", write_through=True)
+    count = export_subscriptions_csv(text)
+    text.detach()
+    fileobj.seek(0)
+    return count
+
+async def export_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("⛔ Unauthorized.")
         return
-    now = int(time.time())
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT user_id, expiry_date FROM subscriptions ORDER BY expiry_date")
-        rows = c.fetchall()
-        conn.close()
-    if not rows:
-        await update.message.reply_text("📭 **No active subscribers.**", parse_mode="Markdown")
+    # The CSV is streamed from the DB into a temp file rather than built up
+    # as a string. PTB still reads the whole file into memory to upload it.
+    with tempfile.TemporaryFile() as f:
+        count = await run_db(_write_export, f)
+        await update.message.reply_document(
+            document=f,
+            filename=f"subscriptions-{datetime.now().strftime('%Y%m%d-%H%M%S')}.csv",
+            caption=f"📤 {count} subscriptions",
+        )
+
+# -------------------- Broadcast Command --------------------
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Unauthorized.")
+        return
+    args = context.args
+    if not args:
+        rows = await run_db(get_recent_broadcasts)
+        if not rows:
+            await update.message.reply_text("📭 No broadcasts yet.")
+            return
+        lines = ["📣 **Recent broadcasts:**"]
+        for b_id, _, created_at, _, audience, status, _, sent, failed, _ in rows:
+            lines.append(
+                f"#{b_id} {status} ({audience}) – ✅ {sent} sent, ❌ {failed} failed – {format_expiry(created_at)}"
+            )
+        await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+        return
+    if args[0] == "cancel":
+        if len(args) != 2 or not args[1].isdigit():
+            await update.message.reply_text("Usage: /broadcast cancel <id>")
+            return
+        if await run_db(finish_broadcast, int(args[1]), "cancelled", int(time.time())):
+            await update.message.reply_text(f"🛑 Broadcast #{args[1]} cancelled.")
+        else:
+            await update.message.reply_text(f"Broadcast #{args[1]} is not running.")
         return
-    lines = ["📋 **Active Subscribers:**\n━━━━━━━━━━━━━━━━━━━━━━━━━"]
-    for uid, exp in rows:
-        status = "✅" if exp > now else "❌"
-        lines.append(f"{status} `{uid}` – expires {format_expiry(exp)}")
-    lines.append("━━━━━━━━━━━━━━━━━━━━━━━━━")
+    # Keep the admin's own line breaks: take everything after the command.
+    text = update.message.text.split(None, 1)[1]
+    audience = "active"
+    if args[0] == "all":
+        audience = "all"
+        text = text.split(None, 1)[1] if len(args) > 1 else ""
+    if not text.strip():
+        await update.message.reply_text("Usage: /broadcast [all] <text>")
+        return
+    broadcast_id = await run_db(create_broadcast, update.effective_user.id, text, audience, int(time.time()))
+    await update.message.reply_text(
+        f"📣 Broadcast #{broadcast_id} queued for {audience} subscribers. "
+        "You'll get a report when it finishes."
+    )
+
+# -------------------- Stats Command --------------------
+STATS_MAX_DAYS = 90
+STATS_METRICS = (
+    ("new_subscribers", "🆕", "new"),
+    ("renewals", "🔁", "renewed"),
+    ("approvals", "✅", "approved"),
+    ("declines", "❌", "declined"),
+    ("churned", "📉", "churned"),
+    ("revenue", "💰", "Birr"),
+)
+
+def format_stats_line(totals):
+    return " · ".join(f"{icon} {totals.get(metric, 0)} {label}" for metric, icon, label in STATS_METRICS)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Unauthorized.")
+        return
+    days = 7
+    if context.args and context.args[0].isdigit():
+        days = max(1, min(STATS_MAX_DAYS, int(context.args[0])))
+    now = int(time.time())
+    today = stats_day(now)
+    month_start = today[:8] + "01"
+    since = min(month_start, stats_day(now - (days - 1) * 86400))
+    counters, rows = await run_db(get_stats, since)
+
+    by_day = {}
+    month = {}
+    for day, metric, value in rows:
+        by_day.setdefault(day, {})[metric] = value
+        if day >= month_start:
+            month[metric] = month.get(metric, 0) + value
+    subscribers = counters.get("subscribers", 0)
+    # Share of everyone subscribed at some point this month who has left.
+    churned = month.get("churned", 0)
+    churn_rate = churned / (subscribers + churned) * 100 if subscribers + churned else 0.0
+
+    lines = [
+        "📊 **Subscription Stats**",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━",
+        f"👥 Subscribers: {subscribers}",
+        f"⏳ Pending payments: {counters.get('pending_payments', 0)}",
+        "",
+        f"**Today:** {format_stats_line(by_day.get(today, {}))}",
+        f"**This month:** {format_stats_line(month)}",
+        f"📉 Monthly churn: {churn_rate:.1f}%",
+        "",
+        f"**Last {days} day(s):**",
+    ]
+    for offset in range(days):
+        day = stats_day(now - offset * 86400)
+        totals = by_day.get(day, {})
+        lines.append(f"`{day}` ✅ {totals.get('approvals', 0)} 💰 {totals.get('revenue', 0)} 📉 {totals.get('churned', 0)}")
     await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
 
-def auto_cleanup():
+# -------------------- Reload Plans Command --------------------
+# Workers also watch the plans file, so an edited price reaches every worker
+# within PLANS_RELOAD_INTERVAL; /reload applies it at once in this one.
+PLANS_RELOAD_INTERVAL = int(os.getenv("PLANS_RELOAD_INTERVAL", "30"))
+
+async def reload_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Unauthorized.")
+        return
+    try:
+        funnel = await asyncio.to_thread(templates.reload_templates)
+    except Exception as e:
+        await update.message.reply_text(f"❌ Could not reload plans, keeping the current ones: {e}")
+        return
+    prices = "\n".join(f"• {months} month(s) – {price} Birr" for months, price in funnel.prices.items())
+    await update.message.reply_text(f"✅ Plans reloaded:\n{prices}")
+
+async def plans_watcher():
     while True:
-        time.sleep(86400)
-        now = int(time.time())
-        expired = get_expired_users(now)
-        if expired:
-            print(f"🧹 Cleaning up {len(expired)} expired users...")
-            for user_id in expired:
-                try:
-                    asyncio.run(application.bot.ban_chat_member(
-                        chat_id=PRIVATE_CHANNEL_ID,
-                        user_id=user_id
-                    ))
-                    remove_subscription(user_id)
-                    asyncio.run(application.bot.send_message(
-                        chat_id=user_id,
-                        text="❌ Your subscription has expired. To renew, please send a new payment screenshot."
-                    ))
-                    print(f"✅ Removed expired user {user_id}")
-                except Exception as e:
-                    print(f"❌ Error cleaning up user {user_id}: {e}")
+        await asyncio.sleep(PLANS_RELOAD_INTERVAL)
+        try:
+            await asyncio.to_thread(templates.reload_if_changed)
+        except Exception:
+            log.exception("Could not reload plan templates")
+
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "25"))
+LIST_SOON_DAYS = int(os.getenv("LIST_SOON_DAYS", "3"))
+LIST_FILTERS = {
+    "all": "All Subscribers",
+    "active": "Active Subscribers",
+    "expired": "Expired Subscribers",
+    "soon": f"Expiring Within {LIST_SOON_DAYS} Days",
+}
+
+async def render_subscriber_page(status, after=None, before=None):
+    """Build the text and navigation keyboard for one /list page.
+
+    Callback data is list:<filter>:<n|p>:<expiry>:<user_id>, where n asks for
+    the page after the cursor and p for the page before it.
+    """
+    now = int(time.time())
+    rows, has_more = await run_db(
+        list_subscriptions_page, status, now, LIST_PAGE_SIZE, after, before, LIST_SOON_DAYS * 86400
+    )
+    if before is not None:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    if rows:
+        lines = [f"📋 **{LIST_FILTERS[status]}:**\n━━━━━━━━━━━━━━━━━━━━━━━━━"]
+        for uid, exp in rows:
+            icon = "✅" if exp > now else "❌"
+            lines.append(f"{icon} `{uid}` – expires {format_expiry(exp)}")
+        lines.append("━━━━━━━━━━━━━━━━━━━━━━━━━")
+        text = "\n".join(lines)
+    else:
+        text = f"📭 **No {LIST_FILTERS[status].lower()}.**"
+
+    keyboard = []
+    nav = []
+    if rows and has_prev:
+        first_uid, first_exp = rows[0]
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"list:{status}:p:{first_exp}:{first_uid}"))
+    if rows and has_next:
+        last_uid, last_exp = rows[-1]
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"list:{status}:n:{last_exp}:{last_uid}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([
+        InlineKeyboardButton(("• " if key == status else "") + key.capitalize(), callback_data=f"list:{key}")
+        for key in LIST_FILTERS
+    ])
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def list_subscribers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Unauthorized.")
+        return
+    status = context.args[0].lower() if context.args else "all"
+    if status not in LIST_FILTERS:
+        await update.message.reply_text(f"Usage: /list [{'|'.join(LIST_FILTERS)}]")
+        return
+    text, reply_markup = await render_subscriber_page(status)
+    await update.message.reply_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+
+async def list_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        await query.edit_message_text("⛔ Unauthorized.")
+        return
+    data = query.data.split(":")
+    status = data[1]
+    if status not in LIST_FILTERS:
+        return
+    after = before = None
+    if len(data) == 5:
+        cursor = (int(data[3]), int(data[4]))
+        if data[2] == "p":
+            before = cursor
         else:
-            print("🧹 No expired users found.")
+            after = cursor
+    text, reply_markup = await render_subscriber_page(status, after, before)
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+
+async def track_invite_joins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member
+    if member_update.chat.id != PRIVATE_CHANNEL_ID or member_update.invite_link is None:
+        return
+    if member_update.new_chat_member.status != ChatMember.MEMBER:
+        return
+    await run_db(mark_invite_link_joined, member_update.invite_link.invite_link, int(time.time()))
 
 # -------------------- Add Handlers to Application --------------------
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("help", help_command))
-application.add_handler(CommandHandler("status", status_command))
-application.add_handler(CommandHandler("renew", renew_request))
-application.add_handler(CommandHandler("approve", approve_manual, filters=filters.User(user_id=ADMIN_IDS)))
-application.add_handler(CommandHandler("list", list_subscribers, filters=filters.User(user_id=ADMIN_IDS)))
-application.add_handler(CallbackQueryHandler(proceed_callback, pattern="^proceed$"))
-application.add_handler(CallbackQueryHandler(plan_callback, pattern="^plan:"))
-application.add_handler(CallbackQueryHandler(handle_callback, pattern="^(approve|decline):"))
-application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+def instrumented(callback):
+    """Wrap a handler callback to record its latency and errors.
+
+    Log records emitted while the handler runs carry the update id, user id
+    and handler name.
+    """
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = update.effective_user
+        token = bind_log_context(
+            update_id=update.update_id, user_id=user.id if user else None, handler=name
+        )
+        started = time.perf_counter()
+        try:
+            result = await callback(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            log.exception("Handler failed", extra={"duration_ms": elapsed_ms(started)})
+            raise
+        else:
+            log.info("Handled update", extra={"duration_ms": elapsed_ms(started), "sampled": True})
+            return result
+        finally:
+            handler_latency.observe(time.perf_counter() - started, name)
+            reset_log_context(token)
+    return wrapper
+
+application.add_handler(CommandHandler("start", instrumented(start)))
+application.add_handler(CommandHandler("help", instrumented(help_command)))
+application.add_handler(CommandHandler("status", instrumented(status_command)))
+application.add_handler(CommandHandler("renew", instrumented(renew_request)))
+application.add_handler(CommandHandler("approve", instrumented(approve_manual), filters=filters.User(user_id=ADMIN_IDS)))
+application.add_handler(CommandHandler("list", instrumented(list_subscribers), filters=filters.User(user_id=ADMIN_IDS)))
+application.add_handler(CommandHandler("broadcast", instrumented(broadcast_command), filters=filters.User(user_id=ADMIN_IDS)))
+application.add_handler(CommandHandler("stats", instrumented(stats_command), filters=filters.User(user_id=ADMIN_IDS)))
+application.add_handler(CommandHandler("reload", instrumented(reload_plans), filters=filters.User(user_id=ADMIN_IDS)))
+application.add_handler(CommandHandler("export", instrumented(export_subscriptions), filters=filters.User(user_id=ADMIN_IDS)))
+application.add_handler(CallbackQueryHandler(instrumented(proceed_callback), pattern="^proceed$"))
+application.add_handler(CallbackQueryHandler(instrumented(plan_callback), pattern="^plan:"))
+application.add_handler(CallbackQueryHandler(instrumented(handle_callback), pattern="^(approve|decline):"))
+application.add_handler(CallbackQueryHandler(instrumented(list_page_callback), pattern="^list:"))
+application.add_handler(MessageHandler(filters.PHOTO, instrumented(handle_photo)))
+application.add_handler(MessageHandler(
+    filters.Document.FileExtension("csv") & filters.User(user_id=ADMIN_IDS),
+    instrumented(import_subscriptions_csv),
+))
+application.add_handler(ChatMemberHandler(instrumented(track_invite_joins), ChatMemberHandler.CHAT_MEMBER))
+
+# -------------------- Bot Event Loop --------------------
+# One long-lived loop per process owns the Application and its HTTP client.
+# Flask request threads submit coroutines to it instead of spinning up a
+# fresh loop per update, so connections are reused and many updates can be
+# in flight at once.
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "55"))
+
+bot_loop = asyncio.new_event_loop()
+
+def _run_bot_loop():
+    asyncio.set_event_loop(bot_loop)
+    bot_loop.run_forever()
+
+bot_loop_thread = threading.Thread(target=_run_bot_loop, name="bot-loop", daemon=True)
+bot_loop_thread.start()
+
+def run_on_bot_loop(coro, timeout=None):
+    """Run a coroutine on the bot loop from any thread and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, bot_loop).result(timeout)
+
+# -------------------- Update Queue --------------------
+# WEBHOOK_MODE=queue acknowledges Telegram as soon as an update is parsed and
+# leaves the handler work to a pool of workers on the bot loop. When the queue
+# is full the webhook answers 503 so Telegram redelivers the update later.
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync")
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.getenv("UPDATE_QUEUE_PUT_TIMEOUT", "0"))
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+
+update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE) if WEBHOOK_MODE == "queue" else None
+update_workers = []
+queue_stats = {
+    "enqueued": 0,
+    "processed": 0,
+    "duplicates": 0,
+    "rejected": 0,
+    "last_lag": 0.0,
+    "max_lag": 0.0,
+}
+_recent_update_ids = OrderedDict()
+_recent_update_ids_lock = threading.Lock()
+
+def claim_update_id(update_id):
+    """Return False if this update_id was already accepted recently."""
+    with _recent_update_ids_lock:
+        if update_id in _recent_update_ids:
+            queue_stats["duplicates"] += 1
+            return False
+        _recent_update_ids[update_id] = None
+        if len(_recent_update_ids) > UPDATE_DEDUP_WINDOW:
+            _recent_update_ids.popitem(last=False)
+        return True
+
+def release_update_id(update_id):
+    """Forget an update_id so Telegram's redelivery is accepted."""
+    with _recent_update_ids_lock:
+        _recent_update_ids.pop(update_id, None)
+
+async def enqueue_update(update):
+    item = (update, time.monotonic())
+    try:
+        if UPDATE_QUEUE_PUT_TIMEOUT > 0:
+            await asyncio.wait_for(update_queue.put(item), UPDATE_QUEUE_PUT_TIMEOUT)
+        else:
+            update_queue.put_nowait(item)
+    except (asyncio.QueueFull, asyncio.TimeoutError):
+        queue_stats["rejected"] += 1
+        return False
+    queue_stats["enqueued"] += 1
+    return True
+
+async def update_worker():
+    while True:
+        update, enqueued_at = await update_queue.get()
+        lag = time.monotonic() - enqueued_at
+        queue_stats["last_lag"] = lag
+        queue_stats["max_lag"] = max(queue_stats["max_lag"], lag)
+        try:
+            await application.process_update(update)
+        except Exception:
+            log.exception("Error processing update", extra={"update_id": update.update_id})
+        finally:
+            queue_stats["processed"] += 1
+            update_queue.task_done()
+
+def start_update_workers():
+    for i in range(UPDATE_WORKERS):
+        update_workers.append(asyncio.create_task(update_worker(), name=f"update-worker-{i}"))
+
+# -------------------- Expiry Scheduler --------------------
+# The leader process keeps a min-heap of the subscriptions that expire within
+# the next EXPIRY_HORIZON seconds and sleeps until the earliest one is due.
+# Subscription writes and removals update the heap through a storage
+# listener; the window is reloaded from the expiry index every half horizon,
+# which also picks up writes made by other gunicorn workers.
+EXPIRY_HORIZON = int(os.getenv("EXPIRY_HORIZON", "3600"))
+LEADER_RETRY_INTERVAL = int(os.getenv("LEADER_RETRY_INTERVAL", "30"))
+ENFORCE_BATCH_SIZE = int(os.getenv("ENFORCE_BATCH_SIZE", "100"))
+ENFORCE_CONCURRENCY = int(os.getenv("ENFORCE_CONCURRENCY", "20"))
+
+background_tasks = []
+_expiry_heap = []
+_expiry_due = {}
+_expiry_lock = threading.Lock()
+_expiry_loaded_until = 0
+_expiry_wakeup = None
+
+def schedule_expiry(user_id, expiry):
+    """Storage listener keeping the heap in step with the subscriptions table."""
+    with _expiry_lock:
+        if expiry is None or expiry > _expiry_loaded_until:
+            _expiry_due.pop(user_id, None)
+            return
+        _expiry_due[user_id] = expiry
+        heapq.heappush(_expiry_heap, (expiry, user_id))
+    if _expiry_wakeup is not None:
+        bot_loop.call_soon_threadsafe(_expiry_wakeup.set)
+
+subscription_listeners.append(schedule_expiry)
+
+async def refill_expiry_heap(now):
+    global _expiry_loaded_until
+    until = now + EXPIRY_HORIZON
+    with _expiry_lock:
+        _expiry_loaded_until = until
+    rows = await run_db(get_subscriptions_expiring_before, until)
+    with _expiry_lock:
+        for user_id, expiry in rows:
+            if _expiry_due.get(user_id) != expiry:
+                _expiry_due[user_id] = expiry
+                heapq.heappush(_expiry_heap, (expiry, user_id))
+
+def pop_due_expiries(now):
+    due = []
+    with _expiry_lock:
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+            expiry, user_id = heapq.heappop(_expiry_heap)
+            if _expiry_due.get(user_id) == expiry:
+                del _expiry_due[user_id]
+                due.append(user_id)
+    return due
+
+def retry_expiry_at(user_id, when):
+    """Put a user whose removal hit flood control back on the heap."""
+    with _expiry_lock:
+        _expiry_due[user_id] = when
+        heapq.heappush(_expiry_heap, (when, user_id))
+
+def next_expiry_at():
+    with _expiry_lock:
+        # Drop entries superseded by a renewal or removal.
+        while _expiry_heap and _expiry_due.get(_expiry_heap[0][1]) != _expiry_heap[0][0]:
+            heapq.heappop(_expiry_heap)
+        return _expiry_heap[0][0] if _expiry_heap else None
+
+async def expire_user(user_id, semaphore):
+    """Remove one expired user from the channel and tell them.
+
+    Returns False if the user couldn't be removed or renewed meanwhile.
+    """
+    async with semaphore:
+        # A kick, not a ban: banned users can't rejoin through invite links,
+        # so a later renewal would hand out a link that doesn't work.
+        try:
+            await call_with_retry(
+                application.bot.ban_chat_member,
+                chat_id=PRIVATE_CHANNEL_ID,
+                user_id=user_id,
+                bucket=api_bucket,
+            )
+        except RetryAfter as e:
+            # Retried once the ban is over, not at the next heap refill.
+            log.warning("Flood control removing user %s, retrying in %ss", user_id, e.retry_after)
+            retry_expiry_at(user_id, time.time() + e.retry_after)
+            return False
+        except Exception as e:
+            log.error("Error cleaning up user %s: %s", user_id, e)
+            return False
+        try:
+            await call_with_retry(
+                application.bot.unban_chat_member,
+                chat_id=PRIVATE_CHANNEL_ID,
+                user_id=user_id,
+                only_if_banned=True,
+                bucket=api_bucket,
+            )
+        except Exception as e:
+            log.error("Could not lift the ban on expired user %s: %s", user_id, e)
+        # A renewal may have committed while the user was being removed.
+        if not await run_db(get_expired_among, [user_id], int(time.time())):
+            log.info("User %s renewed during expiry, sending a fresh invite link", user_id)
+            try:
+                invite_link = await get_invite_link(user_id)
+                await chat_pacer.wait(user_id)
+                await call_with_retry(
+                    application.bot.send_message,
+                    chat_id=user_id,
+                    text=f"🔗 Your subscription is active. Rejoin the channel here:\n{invite_link}",
+                    bucket=api_bucket,
+                )
+            except Exception as e:
+                log.error("Could not send a rejoin link to renewed user %s: %s", user_id, e)
+            return False
+        try:
+            await chat_pacer.wait(user_id)
+            await call_with_retry(
+                application.bot.send_message,
+                chat_id=user_id,
+                text="❌ Your subscription has expired. To renew, please send a new payment screenshot.",
+                bucket=api_bucket,
+            )
+        except Exception as e:
+            log.warning("Could not notify expired user %s: %s", user_id, e)
+        return True
+
+async def enforce_expiries(user_ids):
+    now = int(time.time())
+    expired = await run_db(get_expired_among, user_ids, now)
+    if not expired:
+        return
+    log.info("Cleaning up %d expired users", len(expired))
+    semaphore = asyncio.Semaphore(ENFORCE_CONCURRENCY)
+    with cleanup_duration.time():
+        for i in range(0, len(expired), ENFORCE_BATCH_SIZE):
+            batch = expired[i:i + ENFORCE_BATCH_SIZE]
+            results = await asyncio.gather(*(expire_user(user_id, semaphore) for user_id in batch))
+            banned = [user_id for user_id, ok in zip(batch, results) if ok]
+            removed = await run_db(remove_expired_subscriptions, banned, now) if banned else []
+            log.info("Removed %d/%d expired users", len(removed), len(batch))
+
+async def wait_for_leadership():
+    while not acquire_leader_lock():
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+async def expiry_scheduler():
+    global _expiry_wakeup
+    _expiry_wakeup = asyncio.Event()
+    await wait_for_leadership()
+    log.info("Expiry scheduler running in this worker")
+    next_refill = 0
+    while True:
+        try:
+            now = time.time()
+            if now >= next_refill:
+                await refill_expiry_heap(int(now))
+                next_refill = now + EXPIRY_HORIZON / 2
+            due = pop_due_expiries(now)
+            if due:
+                await enforce_expiries(due)
+                continue
+            _expiry_wakeup.clear()
+            wake_at = min(next_refill, next_expiry_at() or next_refill)
+            try:
+                await asyncio.wait_for(_expiry_wakeup.wait(), max(0, wake_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
+        except Exception:
+            log.exception("Error in expiry scheduler")
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+# -------------------- Invite Link Pool --------------------
+# Approvals take a pre-minted single-use link from the invite_links table
+# instead of waiting on createChatInviteLink. The leader keeps the stock
+# between INVITE_POOL_LOW and INVITE_POOL_TARGET and revokes links that were
+# handed out but not used within INVITE_LINK_ISSUED_TTL. Joins are matched
+# back to their link from chat_member updates.
+INVITE_POOL_LOW = int(os.getenv("INVITE_POOL_LOW", "10"))
+INVITE_POOL_TARGET = int(os.getenv("INVITE_POOL_TARGET", "30"))
+INVITE_POOL_INTERVAL = int(os.getenv("INVITE_POOL_INTERVAL", "30"))
+INVITE_POOL_LINK_TTL = int(os.getenv("INVITE_POOL_LINK_TTL", str(7 * 86400)))
+INVITE_LINK_ISSUED_TTL = int(os.getenv("INVITE_LINK_ISSUED_TTL", "86400"))
+
+async def mint_invite_link(expire_date):
+    invite = await call_with_retry(
+        application.bot.create_chat_invite_link,
+        chat_id=PRIVATE_CHANNEL_ID,
+        member_limit=1,
+        expire_date=expire_date,
+        bucket=api_bucket,
+    )
+    return invite.invite_link
+
+async def get_invite_link(user_id):
+    """Return a single-use invite link for user_id, from the pool when possible."""
+    now = int(time.time())
+    link = await run_db(claim_invite_link, user_id, now, now + INVITE_LINK_ISSUED_TTL)
+    if link is not None:
+        return link
+    log.warning("Invite link pool empty, minting one on demand")
+    expire_date = now + INVITE_LINK_ISSUED_TTL
+    link = await mint_invite_link(expire_date)
+    await run_db(record_issued_invite_link, link, user_id, now, expire_date)
+    return link
+
+async def refill_invite_pool():
+    now = int(time.time())
+    stock = await run_db(count_invite_stock, now + INVITE_LINK_ISSUED_TTL)
+    if stock >= INVITE_POOL_LOW:
+        return
+    expire_date = now + INVITE_POOL_LINK_TTL
+    links = await asyncio.gather(
+        *(mint_invite_link(expire_date) for _ in range(INVITE_POOL_TARGET - stock)),
+        return_exceptions=True,
+    )
+    minted = [link for link in links if isinstance(link, str)]
+    if minted:
+        await run_db(add_invite_links, [(link, now, expire_date) for link in minted])
+    log.info("Invite pool refilled with %d links (%d in stock before)", len(minted), stock)
+
+async def revoke_unused_invite_links():
+    now = int(time.time())
+    links = await run_db(get_invite_links_to_revoke, now - INVITE_LINK_ISSUED_TTL, now + INVITE_LINK_ISSUED_TTL)
+    revoked = []
+    for link in links:
+        try:
+            await call_with_retry(
+                application.bot.revoke_chat_invite_link,
+                chat_id=PRIVATE_CHANNEL_ID,
+                invite_link=link,
+                bucket=api_bucket,
+            )
+            revoked.append(link)
+        except Exception as e:
+            log.error("Could not revoke invite link %s: %s", link, e)
+    if revoked:
+        await run_db(mark_invite_links_revoked, revoked, now)
+        log.info("Revoked %d unused invite links", len(revoked))
+
+async def invite_pool_keeper():
+    await wait_for_leadership()
+    while True:
+        try:
+            await refill_invite_pool()
+            await revoke_unused_invite_links()
+        except Exception:
+            log.exception("Error maintaining invite pool")
+        await asyncio.sleep(INVITE_POOL_INTERVAL)
+
+# -------------------- Broadcast Engine --------------------
+# The leader picks up running broadcasts (including ones interrupted by a
+# restart), pages through recipients with a user_id cursor and sends through
+# the shared global bucket and per-chat pacer. Progress is saved per page, so
+# after a crash at most one page is sent twice.
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_POLL_INTERVAL = int(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+REMINDER_INTERVAL = int(os.getenv("REMINDER_INTERVAL", "600"))
+REMINDER_DAYS = [int(x) for x in os.getenv("REMINDER_DAYS", "3,1").split(",")]
+
+async def send_bulk_message(user_id, text, semaphore, **kwargs):
+    """Send one bulk message.
+
+    Returns True if sent, False if it can never be delivered and None if it
+    timed out. A timed-out send may have gone through, so it isn't repeated.
+    BadRequest and TimedOut are not retried by call_with_retry. Flood control
+    is waited out and the message resent, however long it lasts, so callers
+    never move past a recipient that wasn't attempted.
+    """
+    async with semaphore:
+        while True:
+            await chat_pacer.wait(user_id)
+            try:
+                await call_with_retry(
+                    application.bot.send_message,
+                    chat_id=user_id,
+                    text=text,
+                    bucket=api_bucket,
+                    retry_on=(NetworkError,),
+                    **kwargs,
+                )
+                return True
+            except RetryAfter as e:
+                # The request layer has paused api_bucket for every sender.
+                log.warning("Flood control on bulk message to %s, resending in %ss", user_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (Forbidden, BadRequest):
+                return False
+            except TimedOut:
+                log.warning("Bulk message to %s timed out, not resending", user_id)
+                return None
+
+async def run_broadcast(broadcast):
+    broadcast_id, created_by, _, text, audience, _, cursor, sent, failed, _ = broadcast
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    log.info("Broadcast #%d running from user %d", broadcast_id, cursor)
+    while True:
+        if await run_db(get_broadcast_status, broadcast_id) != "running":
+            return
+        recipients = await run_db(
+            get_broadcast_recipients, audience, cursor, int(time.time()), BROADCAST_PAGE_SIZE
+        )
+        if not recipients:
+            break
+        results = await asyncio.gather(
+            *(send_bulk_message(user_id, text, semaphore) for user_id in recipients),
+            return_exceptions=True,
+        )
+        page_sent = sum(1 for result in results if result is True)
+        cursor = recipients[-1]
+        await run_db(save_broadcast_progress, broadcast_id, cursor, page_sent, len(results) - page_sent)
+        sent += page_sent
+        failed += len(results) - page_sent
+    await run_db(finish_broadcast, broadcast_id, "done", int(time.time()))
+    log.info("Broadcast #%d done: %d sent, %d failed", broadcast_id, sent, failed)
+    try:
+        await application.bot.send_message(
+            chat_id=created_by,
+            text=f"📣 Broadcast #{broadcast_id} finished.\n✅ Sent: {sent}\n❌ Failed: {failed}",
+        )
+    except Exception as e:
+        log.warning("Could not report broadcast #%d: %s", broadcast_id, e)
+
+async def broadcast_runner():
+    await wait_for_leadership()
+    while True:
+        try:
+            for broadcast in await run_db(get_running_broadcasts):
+                await run_broadcast(broadcast)
+        except Exception:
+            log.exception("Error running broadcasts")
+        await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+def reminder_text(days, expiry):
+    return (
+        f"⏰ Your VIP membership expires in {days} day(s), on {format_expiry(expiry)}.\n"
+        "Use /renew to keep your access.\n\n"
+        f"⏰ የቪአይፒ አባልነትዎ በ{days} ቀን ውስጥ ያበቃል።\n"
+        "አባልነትዎን ለማደስ /renew ይጫኑ።"
+    )
+
+async def send_expiry_reminders():
+    now = int(time.time())
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    # Each user only gets the nearest reminder: the 3-day window starts where
+    # the 1-day window ends.
+    bounds = sorted(REMINDER_DAYS)
+    for i, days in enumerate(bounds):
+        kind = f"{days}d"
+        window_start = now + (bounds[i - 1] * 86400 if i else 0)
+        window_end = now + days * 86400
+        after = (0, 0)
+        while True:
+            rows = await run_db(
+                get_reminder_candidates, kind, window_start, window_end, after, BROADCAST_PAGE_SIZE
+            )
+            if not rows:
+                break
+            results = await asyncio.gather(
+                *(send_bulk_message(user_id, reminder_text(days, expiry), semaphore)
+                  for user_id, expiry in rows),
+                return_exceptions=True,
+            )
+            # Transient failures are left unrecorded and retried next sweep;
+            # timeouts are recorded since the reminder may have arrived.
+            done = [
+                (user_id, expiry, kind, now)
+                for (user_id, expiry), result in zip(rows, results)
+                if not isinstance(result, Exception)
+            ]
+            if done:
+                await run_db(record_reminders, done)
+            after = (rows[-1][1], rows[-1][0])
+    await run_db(prune_reminders, now - 7 * 86400)
+
+async def reminder_sweeper():
+    await wait_for_leadership()
+    while True:
+        try:
+            await send_expiry_reminders()
+        except Exception:
+            log.exception("Error sending reminders")
+        await asyncio.sleep(REMINDER_INTERVAL)
 
 # -------------------- Initialize Application --------------------
+async def verify_bot_identity():
+    """Refresh the cached identity with a real getMe, which also checks the token."""
+    try:
+        await application.bot.get_me()
+    except Exception as e:
+        log.error("Could not verify bot identity: %s", e)
+
 async def init_app():
-    await application.initialize()
-asyncio.run(init_app())
+    with startup_phase("init_db"):
+        await run_db(init_db)
+    with startup_phase("initialize"):
+        await application.initialize()
+    with startup_phase("start"):
+        await application.start()
+    if WEBHOOK_MODE == "queue":
+        start_update_workers()
+    background_tasks.append(asyncio.create_task(expiry_scheduler(), name="expiry-scheduler"))
+    background_tasks.append(asyncio.create_task(invite_pool_keeper(), name="invite-pool"))
+    background_tasks.append(asyncio.create_task(broadcast_runner(), name="broadcasts"))
+    background_tasks.append(asyncio.create_task(reminder_sweeper(), name="reminders"))
+    background_tasks.append(asyncio.create_task(plans_watcher(), name="plans-watcher"))
+    background_tasks.append(asyncio.create_task(verify_bot_identity(), name="verify-identity"))
+    startup_timings["ready"] = round(time.perf_counter() - STARTUP_STARTED, 4)
+    log.info("Bot ready", extra={"startup_ms": {k: round(v * 1000) for k, v in startup_timings.items()}})
+
+def _report_init_failure(future):
+    if future.exception() is not None:
+        log.error("Bot initialization failed", exc_info=future.exception())
+
+def init_failed():
+    """True once background initialization has finished with an error.
+
+    The worker then answers 503 to webhooks and health checks, so Telegram
+    redelivers updates and the platform restarts the worker.
+    """
+    return app_ready.done() and app_ready.exception() is not None
+
+# Updates that arrive before this finishes wait in the queue (queue mode) or
+# in the webhook request (sync mode) instead of failing.
+app_ready = asyncio.run_coroutine_threadsafe(init_app(), bot_loop)
+app_ready.add_done_callback(_report_init_failure)
+startup_timings["import"] = round(time.perf_counter() - STARTUP_STARTED, 4)
+
+# -------------------- Shutdown --------------------
+# Called from gunicorn's worker_exit hook. Stopping the Application flushes
+# SQLitePersistence, so user_data buffered in this worker survives a deploy.
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+
+async def stop_app():
+    if update_queue is not None:
+        try:
+            await asyncio.wait_for(update_queue.join(), SHUTDOWN_TIMEOUT / 2)
+        except asyncio.TimeoutError:
+            log.warning("Shutting down with %d updates still queued", update_queue.qsize())
+    for task in background_tasks + update_workers:
+        task.cancel()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+
+def shutdown_app():
+    if not app_ready.done() or app_ready.exception() is not None:
+        return
+    try:
+        run_on_bot_loop(stop_app(), SHUTDOWN_TIMEOUT)
+        log.info("Bot stopped")
+    except Exception:
+        log.exception("Error stopping the bot")
 
 # -------------------- Flask Routes --------------------
 @app.route("/")
 def health():
+    if init_failed():
+        return "Bot initialization failed", 503
     return "Bot is running (webhook mode)", 200
 
+@app.route("/health/startup")
+def startup_health():
+    return jsonify(initialized=app_ready.done() and app_ready.exception() is None, **startup_timings)
+
+@app.route("/health/queue")
+def queue_health():
+    return jsonify(
+        mode=WEBHOOK_MODE,
+        depth=update_queue.qsize() if update_queue else 0,
+        maxsize=UPDATE_QUEUE_SIZE,
+        workers=len(update_workers),
+        **queue_stats,
+    )
+
+@app.route("/health/cache")
+def cache_health():
+    return jsonify(size=expiry_cache_size(), **expiry_cache_stats)
+
+Gauge("bot_update_queue_depth", "Updates waiting in the ingestion queue.",
+      lambda: update_queue.qsize() if update_queue else 0)
+Gauge("bot_update_queue_lag_seconds", "Queue wait of the most recently started update.",
+      lambda: queue_stats["last_lag"])
+Gauge("bot_api_requests_in_flight", "Bot API requests currently using a pooled connection.",
+      lambda: bot.request.in_flight)
+Gauge("bot_api_pool_size", "Connection pool size of the shared Bot API client.", lambda: bot.request.pool_size)
+Gauge("bot_expiry_cache_size", "Entries in the /status expiry cache.", expiry_cache_size)
+CounterFunc("bot_expiry_cache_hits_total", "Expiry cache hits since start.", lambda: expiry_cache_stats["hits"])
+CounterFunc("bot_expiry_cache_misses_total", "Expiry cache misses since start.", lambda: expiry_cache_stats["misses"])
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
     """Handle incoming Telegram updates."""
-    print("✅ Webhook received.")
+    started = time.perf_counter()
+    update_id = None
+    if init_failed():
+        webhook_requests.inc("unavailable")
+        return "Bot initialization failed", 503
     try:
         data = request.get_json(force=True)
         update = Update.de_json(data, application.bot)
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(application.process_update(update))
-        loop.close()
-        print(f"✅ Update {update.update_id} processed.")
+        update_id = update.update_id
+        if not claim_update_id(update_id):
+            log.info("Duplicate update ignored", extra={"update_id": update_id})
+            webhook_requests.inc("duplicate")
+            return "OK", 200
+        if WEBHOOK_MODE == "queue":
+            if not run_on_bot_loop(enqueue_update(update), UPDATE_QUEUE_PUT_TIMEOUT + 5):
+                release_update_id(update_id)
+                log.warning("Update queue full, asking Telegram to retry", extra={"update_id": update_id})
+                webhook_requests.inc("busy")
+                return "Busy", 503, {"Retry-After": "5"}
+            log.info("Update queued", extra={
+                "update_id": update_id, "duration_ms": elapsed_ms(started), "sampled": True,
+            })
+            webhook_requests.inc("queued")
+            return "OK", 200
+        try:
+            app_ready.result(WEBHOOK_TIMEOUT)
+        except Exception:
+            release_update_id(update_id)
+            log.error("Bot not initialized, asking Telegram to retry", extra={"update_id": update_id})
+            webhook_requests.inc("unavailable")
+            return "Bot not ready", 503, {"Retry-After": "5"}
+        run_on_bot_loop(application.process_update(update), WEBHOOK_TIMEOUT)
+        log.info("Update processed", extra={
+            "update_id": update_id, "duration_ms": elapsed_ms(started), "sampled": True,
+        })
+        webhook_requests.inc("processed")
         return "OK", 200
-    except Exception as e:
-        print(f"❌ Error in webhook: {e}")
+    except Exception:
+        log.exception("Error in webhook", extra={"update_id": update_id})
+        webhook_requests.inc("error")
         return "OK", 200
 
 @app.route("/set_webhook")
 def set_webhook():
-    """Register the webhook with Telegram using a temporary bot."""
+    """Register the webhook with Telegram through the application's bot."""
     try:
         public_url = os.environ.get('RENDER_EXTERNAL_URL', request.host_url.rstrip('/'))
         if public_url.startswith('http://'):
             public_url = public_url.replace('http://', 'https://', 1)
         webhook_url = f"{public_url}/webhook"
 
-        from telegram import Bot
-        temp_bot = Bot(token=BOT_TOKEN)
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(temp_bot.set_webhook(url=webhook_url))
-        loop.close()
+        app_ready.result(WEBHOOK_TIMEOUT)
+        # chat_member updates are opt-in; the invite pool needs them to see joins.
+        run_on_bot_loop(application.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES))
         return f"✅ Webhook set to {webhook_url}"
     except Exception as e:
         return f"❌ Error: {e}", 500
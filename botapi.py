@@ -0,0 +1,94 @@
+import os
+import time
+import random
+import asyncio
+import importlib.util
+import httpx
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from telegram._utils.defaultvalue import DEFAULT_NONE
+from metrics import api_latency, api_errors, api_retries
+
+# -------------------- Settings --------------------
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "256"))
+BOT_API_KEEPALIVE = int(os.getenv("BOT_API_KEEPALIVE", str(BOT_API_POOL_SIZE)))
+BOT_API_KEEPALIVE_EXPIRY = float(os.getenv("BOT_API_KEEPALIVE_EXPIRY", "60"))
+# "auto" turns HTTP/2 on only when the h2 package is installed.
+BOT_API_HTTP2 = os.getenv("BOT_API_HTTP2", "auto")
+BOT_API_RETRIES = int(os.getenv("BOT_API_RETRIES", "2"))
+# A longer flood wait is raised to the caller instead of holding a worker.
+BOT_API_MAX_RETRY_AFTER = float(os.getenv("BOT_API_MAX_RETRY_AFTER", "10"))
+
+# Timeouts that differ from the client defaults, by Bot API method. Only
+# applied when the caller didn't pass its own.
+METHOD_TIMEOUTS = {
+    "getMe": {"read_timeout": 3.0},
+    "sendDocument": {"read_timeout": 30.0, "write_timeout": 60.0},
+    "sendPhoto": {"read_timeout": 15.0, "write_timeout": 20.0},
+    "setWebhook": {"read_timeout": 15.0},
+    "createChatInviteLink": {"read_timeout": 10.0},
+    "banChatMember": {"read_timeout": 10.0},
+}
+
+def _http2_enabled():
+    if BOT_API_HTTP2 == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return BOT_API_HTTP2.lower() in ("1", "true", "yes")
+
+# -------------------- Request Layer --------------------
+class BotAPIRequest(HTTPXRequest):
+    """The one HTTPX client every outbound Bot API call goes through.
+
+    Adds keep-alive tuning, per-method timeouts, latency/error metrics and
+    transparent retries of flood-control (429) responses. `on_flood` is called
+    with the retry delay on every 429, including ones raised to the caller, so
+    a shared rate limiter backs off for the whole ban.
+    """
+
+    def __init__(self, on_flood=None, **kwargs):
+        self.on_flood = on_flood
+        self.in_flight = 0
+        kwargs.setdefault("connection_pool_size", BOT_API_POOL_SIZE)
+        kwargs.setdefault("http_version", "2" if _http2_enabled() else "1.1")
+        self.pool_size = kwargs["connection_pool_size"]
+        super().__init__(**kwargs)
+
+    def _build_client(self):
+        limits = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=min(BOT_API_KEEPALIVE, self.pool_size),
+            keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY,
+        )
+        return httpx.AsyncClient(**dict(self._client_kwargs, limits=limits))
+
+    async def post(self, url, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        for attempt in range(BOT_API_RETRIES + 1):
+            try:
+                return await super().post(url, *args, **kwargs)
+            except RetryAfter as e:
+                if self.on_flood is not None:
+                    self.on_flood(e.retry_after)
+                if attempt == BOT_API_RETRIES or e.retry_after > BOT_API_MAX_RETRY_AFTER:
+                    raise
+                api_retries.inc(api_method, "flood")
+                await asyncio.sleep(e.retry_after + random.uniform(0, 1))
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        for name, value in METHOD_TIMEOUTS.get(api_method, {}).items():
+            if kwargs.get(name, DEFAULT_NONE) is DEFAULT_NONE:
+                kwargs[name] = value
+        started = time.perf_counter()
+        self.in_flight += 1
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            api_errors.inc(api_method)
+            raise
+        finally:
+            self.in_flight -= 1
+            api_latency.observe(time.perf_counter() - started, api_method)
+        if code >= 300:
+            api_errors.inc(api_method)
+        return code, payload
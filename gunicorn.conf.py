@@ -0,0 +1,22 @@
+import os
+
+# The bot runs its own asyncio loop thread per worker process (see bot.py),
+# so request threads only hand updates over to it. Threaded workers let one
+# process keep many updates in flight instead of one per worker.
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "64"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+keepalive = 75
+
+# Each worker must import bot.py itself: the loop thread and the Application's
+# HTTP client do not survive a fork.
+preload_app = False
+
+def worker_exit(server, worker):
+    # Flush buffered user_data and drain queued updates before the worker exits.
+    import sys
+    bot = sys.modules.get("bot")
+    if bot is not None:
+        bot.shutdown_app()
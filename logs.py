@@ -0,0 +1,108 @@
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+from contextvars import ContextVar
+
+# -------------------- Settings --------------------
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Share of high-volume success lines (marked with extra={"sampled": True})
+# that are kept. Warnings and errors are never sampled.
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+
+# Fields attached to every record logged while handling an update. Each
+# asyncio task runs in its own copy of the context, so concurrent updates
+# don't see each other's fields.
+log_context = ContextVar("log_context", default={})
+
+def bind_log_context(**fields):
+    """Add fields to the current context. Returns a token for reset_log_context."""
+    return log_context.set({**log_context.get(), **fields})
+
+def reset_log_context(token):
+    log_context.reset(token)
+
+# -------------------- Formatting --------------------
+# Attributes every LogRecord has; anything else came in through `extra`.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "sampled"}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class ContextFilter(logging.Filter):
+    """Copy the bound context fields onto the record in the logging thread."""
+
+    def filter(self, record):
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and record.levelno < logging.WARNING:
+            return random.random() < self.rate
+        return True
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps the traceback apart from the message text."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+# -------------------- Setup --------------------
+# Callers only put records on an in-memory queue; a listener thread formats
+# them and does the blocking write to stdout.
+_listener = None
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+    records = queue.SimpleQueue()
+    queue_handler = RecordQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    queue_handler.addFilter(ContextFilter())
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every request at INFO, which would double our own volume.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(records, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
@@ -0,0 +1,149 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# -------------------- Metric Types --------------------
+# A small in-process registry rendered in the Prometheus text format. Each
+# update is a dict lookup plus a few additions under an uncontended lock, so
+# instrumenting the hot path costs next to nothing.
+REGISTRY = []
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    inner = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs
+    )
+    return "{" + inner + "}"
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Gauge:
+    """A gauge read from `func` at scrape time."""
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        REGISTRY.append(self)
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+            f"{self.name} {self.func()}",
+        ]
+
+class CounterFunc(Gauge):
+    """A monotonic counter read from `func` at scrape time."""
+
+    TYPE = "counter"
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}"
+                )
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# -------------------- Shared Metrics --------------------
+handler_latency = Histogram(
+    "bot_handler_duration_seconds", "Time spent in each update handler.", ("handler",)
+)
+handler_errors = Counter(
+    "bot_handler_errors_total", "Exceptions raised by update handlers.", ("handler",)
+)
+api_latency = Histogram(
+    "bot_api_request_duration_seconds", "Outbound Bot API request latency.", ("method",)
+)
+api_errors = Counter(
+    "bot_api_errors_total", "Outbound Bot API requests that failed or returned non-2xx.", ("method",)
+)
+api_retries = Counter(
+    "bot_api_retries_total", "Outbound Bot API requests retried, by reason.", ("method", "reason")
+)
+db_lock_wait = Histogram(
+    "bot_db_lock_wait_seconds", "Time spent waiting for the SQLite writer lock.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+db_lock_hold = Histogram(
+    "bot_db_lock_hold_seconds", "Time the SQLite writer lock was held per transaction.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+webhook_requests = Counter(
+    "bot_webhook_requests_total", "Webhook deliveries by outcome.", ("result",)
+)
+cleanup_duration = Histogram(
+    "bot_expiry_sweep_duration_seconds", "Duration of each expiry enforcement sweep.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0),
+)
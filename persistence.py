@@ -0,0 +1,171 @@
+import json
+import asyncio
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+from storage import (
+    PERSISTENT_TABLES,
+    save_persistent_data,
+    load_persistent_data,
+    load_persistent_changes,
+    get_persistent_cursor,
+    run_db,
+)
+
+log = logging.getLogger(__name__)
+
+SYNC_PAGE_SIZE = 1000
+
+class SQLitePersistence(BasePersistence):
+    """Keep user_data and chat_data in the subscriptions database.
+
+    Data is loaded lazily the first time this process sees a user or chat and
+    is then served from memory. Changes handed over by the Application are
+    buffered and written in one transaction per flush, and only when they
+    differ from what was last stored. A background task tails the seq column
+    to pick up writes made by other gunicorn workers, so a plan chosen on one
+    worker is there when the screenshot lands on another.
+
+    Values must be JSON serializable.
+    """
+
+    def __init__(self, update_interval=1, flush_delay=0.1, sync_interval=1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.flush_delay = flush_delay
+        self.sync_interval = sync_interval
+        self._stored = {table: {} for table in PERSISTENT_TABLES}
+        self._dirty = {table: {} for table in PERSISTENT_TABLES}
+        self._incoming = {table: {} for table in PERSISTENT_TABLES}
+        # (seq, id) of the last row seen from other workers, per table.
+        self._cursor = {table: (0, 0) for table in PERSISTENT_TABLES}
+        self._flush_task = None
+        self._sync_task = None
+
+    # ---------- loading ----------
+    async def _start_sync(self):
+        if self._sync_task is not None:
+            return
+        for table in PERSISTENT_TABLES:
+            self._cursor[table] = await run_db(get_persistent_cursor, table)
+        self._sync_task = asyncio.create_task(self._sync_loop(), name="persistence-sync")
+
+    async def get_user_data(self):
+        await self._start_sync()
+        return {}
+
+    async def get_chat_data(self):
+        await self._start_sync()
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def _refresh(self, table, key, data):
+        if key in self._dirty[table]:
+            return
+        if key not in self._stored[table]:
+            text = await run_db(load_persistent_data, table, key) or "{}"
+            self._stored[table][key] = text
+            self._incoming[table].pop(key, None)
+            fresh = json.loads(text)
+        else:
+            fresh = self._incoming[table].pop(key, None)
+        if fresh is not None:
+            data.clear()
+            data.update(fresh)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user_data", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat_data", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            for table in PERSISTENT_TABLES:
+                try:
+                    await self._sync_table(table)
+                except Exception:
+                    log.exception("Error syncing %s", table)
+
+    async def _sync_table(self, table):
+        stored = self._stored[table]
+        while True:
+            rows = await run_db(load_persistent_changes, table, self._cursor[table], SYNC_PAGE_SIZE)
+            for key, text, seq in rows:
+                self._cursor[table] = (seq, key)
+                # Keys this process has never loaded are read on first use.
+                if key in stored and stored[key] != text and key not in self._dirty[table]:
+                    stored[key] = text
+                    self._incoming[table][key] = json.loads(text)
+            if len(rows) < SYNC_PAGE_SIZE:
+                return
+
+    # ---------- saving ----------
+    def _mark(self, table, key, data):
+        text = json.dumps(data, sort_keys=True)
+        if self._dirty[table].get(key, self._stored[table].get(key)) == text:
+            return
+        self._dirty[table][key] = text
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush(), name="persistence-flush")
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        self._flush_task = None
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        for table in PERSISTENT_TABLES:
+            dirty = self._dirty[table]
+            if not dirty:
+                continue
+            rows = list(dirty.items())
+            try:
+                await run_db(save_persistent_data, table, rows)
+            except Exception:
+                log.exception("Error saving %s", table)
+                continue
+            for key, text in rows:
+                self._stored[table][key] = text
+                if dirty.get(key) == text:
+                    del dirty[key]
+
+    async def update_user_data(self, user_id, data):
+        self._mark("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._mark("chat_data", chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._mark("user_data", user_id, {})
+
+    async def drop_chat_data(self, chat_id):
+        self._mark("chat_data", chat_id, {})
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def flush(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write_dirty()
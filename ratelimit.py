@@ -0,0 +1,81 @@
+import time
+import random
+import asyncio
+from collections import OrderedDict
+from telegram.error import BadRequest, TimedOut
+
+# -------------------- Token Bucket --------------------
+class TokenBucket:
+    """Async token bucket refilling `rate` tokens per second up to `capacity`.
+
+    pause() stops handing out tokens for a while, which is how a 429 from
+    Telegram slows down every caller sharing the bucket, not just the one
+    that was rejected.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+# -------------------- Per-Chat Pacing --------------------
+class ChatPacer:
+    """Space out messages to the same chat by at least `interval` seconds."""
+
+    def __init__(self, interval, max_chats=10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_slot = OrderedDict()
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.interval
+        self._next_slot.move_to_end(chat_id)
+        while len(self._next_slot) > self.max_chats:
+            self._next_slot.popitem(last=False)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+# -------------------- Retries --------------------
+# BadRequest and TimedOut subclass NetworkError but are never retried: a bad
+# request fails the same way again, and a timed-out send may already have
+# been delivered, so repeating it could message the user twice.
+NOT_RETRYABLE = (BadRequest, TimedOut)
+
+async def call_with_retry(func, *args, bucket=None, attempts=3, retry_on=(), backoff=0.5, **kwargs):
+    """Await func(*args, **kwargs), taking a token from `bucket` per attempt.
+
+    Exceptions listed in `retry_on` are retried with jittered exponential
+    backoff, except for NOT_RETRYABLE errors. Flood control (RetryAfter) is
+    handled once, in botapi.BotAPIRequest, which also pauses the bucket.
+    """
+    for attempt in range(attempts):
+        if bucket is not None:
+            await bucket.acquire()
+        try:
+            return await func(*args, **kwargs)
+        except retry_on as e:
+            if attempt == attempts - 1 or isinstance(e, NOT_RETRYABLE):
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt * random.uniform(1, 2))
@@ -0,0 +1,699 @@
+import os
+import csv
+import sqlite3
+import threading
+import time
+import fcntl
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from metrics import db_lock_wait, db_lock_hold
+
+# -------------------- Connections --------------------
+# One long-lived writer connection per process, serialized by db_lock, plus
+# one long-lived read-only connection per thread. In WAL mode readers never
+# wait for the writer, and BEGIN IMMEDIATE keeps writers from different
+# gunicorn workers from deadlocking each other.
+DB_PATH = os.getenv("DB_PATH", "subscriptions.db")
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+
+LEADER_LOCK_PATH = DB_PATH + ".leader"
+
+db_lock = threading.Lock()
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+_writer = None
+_local = threading.local()
+_leader_fd = None
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        isolation_level=None,
+        check_same_thread=False,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def read_connection():
+    """Return this thread's long-lived read-only connection."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+@contextmanager
+def write_transaction():
+    """Yield the writer connection inside a BEGIN IMMEDIATE transaction."""
+    global _writer
+    waited_from = time.perf_counter()
+    with db_lock:
+        acquired_at = time.perf_counter()
+        db_lock_wait.observe(acquired_at - waited_from)
+        try:
+            if _writer is None:
+                _writer = _connect()
+            _writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield _writer
+            except BaseException:
+                _writer.execute("ROLLBACK")
+                raise
+            _writer.execute("COMMIT")
+        finally:
+            db_lock_hold.observe(time.perf_counter() - acquired_at)
+
+async def run_db(func, *args):
+    """Run a blocking storage call on the DB thread pool, off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+def acquire_leader_lock():
+    """Try to become the one process that runs background jobs.
+
+    The flock is held for the life of the process and released by the kernel
+    when it exits, so another gunicorn worker can take over.
+    """
+    global _leader_fd
+    if _leader_fd is not None:
+        return True
+    fd = os.open(LEADER_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _leader_fd = fd
+    return True
+
+# -------------------- Schema --------------------
+PERSISTENT_TABLES = ("user_data", "chat_data")
+
+def init_db():
+    with write_transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS subscriptions (
+                        user_id INTEGER PRIMARY KEY,
+                        expiry_date INTEGER NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_expiry ON subscriptions (expiry_date)")
+        conn.execute('''CREATE TABLE IF NOT EXISTS invite_links (
+                        invite_link TEXT PRIMARY KEY,
+                        created_at INTEGER NOT NULL,
+                        expire_date INTEGER NOT NULL,
+                        user_id INTEGER,
+                        issued_at INTEGER,
+                        joined_at INTEGER,
+                        revoked_at INTEGER)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_invite_links_issued ON invite_links (issued_at, expire_date)")
+        conn.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        created_by INTEGER NOT NULL,
+                        created_at INTEGER NOT NULL,
+                        text TEXT NOT NULL,
+                        audience TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'running',
+                        cursor INTEGER NOT NULL DEFAULT 0,
+                        sent INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        finished_at INTEGER)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS reminders (
+                        user_id INTEGER NOT NULL,
+                        expiry_date INTEGER NOT NULL,
+                        kind TEXT NOT NULL,
+                        sent_at INTEGER NOT NULL,
+                        PRIMARY KEY (user_id, expiry_date, kind))''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS payments (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        file_unique_id TEXT NOT NULL UNIQUE,
+                        user_id INTEGER NOT NULL,
+                        months INTEGER NOT NULL,
+                        amount INTEGER,
+                        state TEXT NOT NULL DEFAULT 'pending',
+                        created_at INTEGER NOT NULL,
+                        decided_by INTEGER,
+                        decided_at INTEGER,
+                        delivery_started_at INTEGER,
+                        delivered_at INTEGER)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+                        name TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS stats_daily (
+                        day TEXT NOT NULL,
+                        metric TEXT NOT NULL,
+                        value INTEGER NOT NULL,
+                        PRIMARY KEY (day, metric))''')
+        # Seed the running totals once from the tables they summarise.
+        if conn.execute("SELECT 1 FROM stats_counters WHERE name = 'subscribers'").fetchone() is None:
+            conn.execute("INSERT INTO stats_counters SELECT 'subscribers', COUNT(*) FROM subscriptions")
+            conn.execute(
+                "INSERT OR REPLACE INTO stats_counters "
+                "SELECT 'pending_payments', COUNT(*) FROM payments WHERE state = 'pending'"
+            )
+        for table in PERSISTENT_TABLES:
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                            id INTEGER PRIMARY KEY,
+                            data TEXT NOT NULL,
+                            seq INTEGER NOT NULL)''')
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_seq ON {table} (seq)")
+
+# -------------------- Statistics --------------------
+# Running totals (stats_counters) and per-day rollups (stats_daily) are
+# updated inside the same transaction as the write they describe, so /stats
+# reads a handful of rows however many subscribers there are. Days are in
+# server local time, like format_expiry.
+def stats_day(timestamp):
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+def _record_stats(conn, now, counters=(), daily=()):
+    """Apply counter deltas and daily metric deltas, given as (name, delta) pairs."""
+    conn.executemany(
+        "INSERT INTO stats_counters VALUES (?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+        [(name, delta) for name, delta in counters if delta],
+    )
+    day = stats_day(now)
+    conn.executemany(
+        "INSERT INTO stats_daily VALUES (?, ?, ?) "
+        "ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value",
+        [(day, metric, delta) for metric, delta in daily if delta],
+    )
+
+def record_daily_stats(now, metrics):
+    """Add {metric: delta} to today's rollup outside of any other write."""
+    with write_transaction() as conn:
+        _record_stats(conn, now, daily=metrics.items())
+
+def get_stats(since_day):
+    """Return ({counter: value}, [(day, metric, value)]) for days >= since_day."""
+    conn = read_connection()
+    counters = dict(conn.execute("SELECT name, value FROM stats_counters").fetchall())
+    daily = conn.execute(
+        "SELECT day, metric, value FROM stats_daily WHERE day >= ? ORDER BY day", (since_day,)
+    ).fetchall()
+    return counters, daily
+
+# -------------------- Subscriptions --------------------
+# Callables invoked as listener(user_id, expiry) after a subscription is
+# written, with expiry=None once it is removed. They run in the writing
+# thread and must not block.
+subscription_listeners = []
+
+def _notify_listeners(user_id, expiry):
+    for listener in subscription_listeners:
+        listener(user_id, expiry)
+
+def _put_subscriptions(conn, rows, now):
+    """REPLACE (user_id, expiry_date) rows, counting new subscribers and renewals."""
+    rows = dict(rows)
+    existing = set()
+    user_ids = list(rows)
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        existing.update(row[0] for row in conn.execute(
+            f"SELECT user_id FROM subscriptions WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
+        ))
+    conn.executemany("REPLACE INTO subscriptions (user_id, expiry_date) VALUES (?, ?)", list(rows.items()))
+    added = len(rows) - len(existing)
+    _record_stats(
+        conn, now,
+        counters=[("subscribers", added)],
+        daily=[("new_subscribers", added), ("renewals", len(existing))],
+    )
+
+def add_subscription(user_id, days):
+    now = int(time.time())
+    expiry = now + days * 86400
+    with write_transaction() as conn:
+        _put_subscriptions(conn, [(user_id, expiry)], now)
+    _notify_listeners(user_id, expiry)
+    return expiry
+
+def add_subscriptions(rows):
+    """Grant (user_id, days) pairs in one transaction. Returns {user_id: expiry}."""
+    now = int(time.time())
+    expiries = {user_id: now + days * 86400 for user_id, days in rows}
+    with write_transaction() as conn:
+        _put_subscriptions(conn, expiries.items(), now)
+    for user_id, expiry in expiries.items():
+        _notify_listeners(user_id, expiry)
+    return expiries
+
+def import_subscriptions(rows):
+    """Upsert (user_id, expiry_date) pairs in one transaction."""
+    with write_transaction() as conn:
+        _put_subscriptions(conn, rows, int(time.time()))
+    for user_id, expiry in rows:
+        _notify_listeners(user_id, expiry)
+
+def export_subscriptions_csv(fileobj, batch_size=1000):
+    """Stream the subscriptions table to a text file object as CSV.
+
+    Rows are pulled from the cursor in batches, so memory use doesn't grow
+    with the table. Returns the number of rows written.
+    """
+    writer = csv.writer(fileobj)
+    writer.writerow(["user_id", "expiry_date", "expires_at_utc"])
+    cur = read_connection().execute("SELECT user_id, expiry_date FROM subscriptions ORDER BY user_id")
+    count = 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        writer.writerows(
+            (user_id, expiry, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(expiry)))
+            for user_id, expiry in rows
+        )
+        count += len(rows)
+    return count
+
+def remove_expired_subscriptions(user_ids, now):
+    """Delete a batch of expired rows in one transaction.
+
+    Rows renewed after `now` are left alone. Returns the ids actually removed.
+    """
+    removed = []
+    with write_transaction() as conn:
+        for user_id in user_ids:
+            cur = conn.execute(
+                "DELETE FROM subscriptions WHERE user_id = ? AND expiry_date <= ?", (user_id, now)
+            )
+            if cur.rowcount:
+                removed.append(user_id)
+        _record_stats(
+            conn, now, counters=[("subscribers", -len(removed))], daily=[("churned", len(removed))]
+        )
+    for user_id in removed:
+        _notify_listeners(user_id, None)
+    return removed
+
+def get_expired_among(user_ids, now):
+    """Return the subset of user_ids whose subscription has expired by `now`."""
+    expired = []
+    conn = read_connection()
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT user_id FROM subscriptions WHERE expiry_date <= ? AND user_id IN ({placeholders})",
+            (now, *chunk),
+        ).fetchall()
+        expired.extend(row[0] for row in rows)
+    return expired
+
+def get_subscriptions_expiring_before(deadline):
+    return read_connection().execute(
+        "SELECT user_id, expiry_date FROM subscriptions WHERE expiry_date <= ? ORDER BY expiry_date",
+        (deadline,),
+    ).fetchall()
+
+def get_subscription_expiry(user_id):
+    row = read_connection().execute(
+        "SELECT expiry_date FROM subscriptions WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+# -------------------- Expiry Cache --------------------
+# Read-through LRU cache for /status. Writes in this process invalidate
+# entries through a subscription listener; writes made by other gunicorn
+# workers are picked up once the short TTL runs out. Non-subscribers are
+# cached too, with a shorter TTL, since they are the ones spamming /status.
+EXPIRY_CACHE_SIZE = int(os.getenv("EXPIRY_CACHE_SIZE", "10000"))
+EXPIRY_CACHE_TTL = float(os.getenv("EXPIRY_CACHE_TTL", "30"))
+EXPIRY_CACHE_NEGATIVE_TTL = float(os.getenv("EXPIRY_CACHE_NEGATIVE_TTL", "10"))
+
+expiry_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+_expiry_cache = OrderedDict()
+_expiry_cache_lock = threading.Lock()
+_expiry_cache_version = 0
+
+def get_subscription_expiry_cached(user_id):
+    now = time.monotonic()
+    with _expiry_cache_lock:
+        entry = _expiry_cache.get(user_id)
+        if entry is not None:
+            expiry, cached_at = entry
+            ttl = EXPIRY_CACHE_TTL if expiry is not None else EXPIRY_CACHE_NEGATIVE_TTL
+            if now - cached_at < ttl:
+                _expiry_cache.move_to_end(user_id)
+                expiry_cache_stats["hits"] += 1
+                return expiry
+            del _expiry_cache[user_id]
+        expiry_cache_stats["misses"] += 1
+        version = _expiry_cache_version
+    expiry = get_subscription_expiry(user_id)
+    with _expiry_cache_lock:
+        # Don't cache a value read while a write to the table was landing.
+        if version == _expiry_cache_version:
+            _expiry_cache[user_id] = (expiry, now)
+            _expiry_cache.move_to_end(user_id)
+            while len(_expiry_cache) > EXPIRY_CACHE_SIZE:
+                _expiry_cache.popitem(last=False)
+                expiry_cache_stats["evictions"] += 1
+    return expiry
+
+def invalidate_cached_expiry(user_id, expiry=None):
+    global _expiry_cache_version
+    with _expiry_cache_lock:
+        _expiry_cache_version += 1
+        if _expiry_cache.pop(user_id, None) is not None:
+            expiry_cache_stats["invalidations"] += 1
+
+def expiry_cache_size():
+    return len(_expiry_cache)
+
+subscription_listeners.append(invalidate_cached_expiry)
+
+def list_subscriptions_page(status, now, limit, after=None, before=None, soon_window=3 * 86400):
+    """Fetch one page of subscriptions ordered by (expiry_date, user_id).
+
+    `after`/`before` are (expiry_date, user_id) cursors taken from the last or
+    first row of the neighbouring page, so each page reads only its own rows
+    off the expiry index. Returns (rows, has_more) where has_more tells
+    whether further rows exist in the direction of travel.
+    """
+    conditions, params = [], []
+    if status == "active":
+        conditions.append("expiry_date > ?")
+        params.append(now)
+    elif status == "expired":
+        conditions.append("expiry_date <= ?")
+        params.append(now)
+    elif status == "soon":
+        conditions.append("expiry_date > ? AND expiry_date <= ?")
+        params.extend((now, now + soon_window))
+    if before is not None:
+        conditions.append("(expiry_date, user_id) < (?, ?)")
+        params.extend(before)
+        order = "DESC"
+    else:
+        if after is not None:
+            conditions.append("(expiry_date, user_id) > (?, ?)")
+            params.extend(after)
+        order = "ASC"
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = read_connection().execute(
+        f"SELECT user_id, expiry_date FROM subscriptions {where} "
+        f"ORDER BY expiry_date {order}, user_id {order} LIMIT ?",
+        (*params, limit + 1),
+    ).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+    return rows, has_more
+
+# -------------------- Invite Links --------------------
+# Single-use links for the private channel. A link is in stock while
+# issued_at is NULL, then records the user it was handed to and, once
+# Telegram reports the join, when it was used.
+def add_invite_links(rows):
+    """Store freshly minted (invite_link, created_at, expire_date) rows as stock."""
+    with write_transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO invite_links (invite_link, created_at, expire_date) VALUES (?, ?, ?)",
+            rows,
+        )
+
+def claim_invite_link(user_id, now, min_expire):
+    """Hand the oldest usable stock link to user_id. Returns None if out of stock."""
+    with write_transaction() as conn:
+        row = conn.execute(
+            "SELECT invite_link FROM invite_links "
+            "WHERE issued_at IS NULL AND revoked_at IS NULL AND expire_date >= ? "
+            "ORDER BY expire_date LIMIT 1",
+            (min_expire,),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE invite_links SET user_id = ?, issued_at = ? WHERE invite_link = ?",
+            (user_id, now, row[0]),
+        )
+    return row[0]
+
+def record_issued_invite_link(invite_link, user_id, now, expire_date):
+    """Record a link minted on demand because the pool was empty."""
+    with write_transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO invite_links "
+            "(invite_link, created_at, expire_date, user_id, issued_at) VALUES (?, ?, ?, ?, ?)",
+            (invite_link, now, expire_date, user_id, now),
+        )
+
+def count_invite_stock(min_expire):
+    return read_connection().execute(
+        "SELECT COUNT(*) FROM invite_links "
+        "WHERE issued_at IS NULL AND revoked_at IS NULL AND expire_date >= ?",
+        (min_expire,),
+    ).fetchone()[0]
+
+def mark_invite_link_joined(invite_link, now):
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE invite_links SET joined_at = ? WHERE invite_link = ? AND joined_at IS NULL",
+            (now, invite_link),
+        )
+
+def get_invite_links_to_revoke(issued_before, stock_expiring_before, limit=100):
+    """Links issued but never used, plus stock too close to expiry to hand out."""
+    return [row[0] for row in read_connection().execute(
+        "SELECT invite_link FROM invite_links WHERE revoked_at IS NULL AND joined_at IS NULL "
+        "AND ((issued_at IS NOT NULL AND issued_at <= ?) "
+        "OR (issued_at IS NULL AND expire_date < ?)) LIMIT ?",
+        (issued_before, stock_expiring_before, limit),
+    ).fetchall()]
+
+def mark_invite_links_revoked(invite_links, now):
+    with write_transaction() as conn:
+        conn.executemany(
+            "UPDATE invite_links SET revoked_at = ? WHERE invite_link = ?",
+            [(now, link) for link in invite_links],
+        )
+
+# -------------------- Payments --------------------
+# One row per payment screenshot, keyed by Telegram's file_unique_id so the
+# same image resent (or forwarded again) maps to the same payment. State only
+# ever moves out of 'pending' once, which makes approve/decline idempotent.
+def record_payment(file_unique_id, user_id, months, amount, now):
+    """Store a new pending payment.
+
+    Returns (payment_id, None) for a new screenshot, or (payment_id, state)
+    of the existing payment if this screenshot was already submitted.
+    """
+    with write_transaction() as conn:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO payments (file_unique_id, user_id, months, amount, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (file_unique_id, user_id, months, amount, now),
+        )
+        if cur.rowcount:
+            _record_stats(conn, now, counters=[("pending_payments", 1)], daily=[("payments", 1)])
+            return cur.lastrowid, None
+        return conn.execute(
+            "SELECT id, state FROM payments WHERE file_unique_id = ?", (file_unique_id,)
+        ).fetchone()
+
+def discard_payment(payment_id):
+    """Forget a pending payment that no admin was shown, so it can be resent.
+
+    Returns False if the payment was already decided.
+    """
+    with write_transaction() as conn:
+        row = conn.execute(
+            "SELECT created_at FROM payments WHERE id = ? AND state = 'pending'", (payment_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM payments WHERE id = ?", (payment_id,))
+        _record_stats(conn, row[0], counters=[("pending_payments", -1)], daily=[("payments", -1)])
+    return True
+
+def get_payment_status(payment_id):
+    """Return (state, delivered_at) for a payment, or (None, None) if unknown."""
+    row = read_connection().execute(
+        "SELECT state, delivered_at FROM payments WHERE id = ?", (payment_id,)
+    ).fetchone()
+    return row or (None, None)
+
+def claim_payment_delivery(payment_id, now, stale_before):
+    """Take over sending the invite link of an approved, undelivered payment.
+
+    Only one caller wins; a claim older than `stale_before` is assumed to
+    belong to a delivery that died and can be taken again.
+    """
+    with write_transaction() as conn:
+        cur = conn.execute(
+            "UPDATE payments SET delivery_started_at = ? "
+            "WHERE id = ? AND state = 'approved' AND delivered_at IS NULL "
+            "AND (delivery_started_at IS NULL OR delivery_started_at < ?)",
+            (now, payment_id, stale_before),
+        )
+    return cur.rowcount > 0
+
+def release_payment_delivery(payment_id):
+    """Drop a failed delivery's claim so the next click can resend at once."""
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE payments SET delivery_started_at = NULL WHERE id = ? AND delivered_at IS NULL",
+            (payment_id,),
+        )
+
+def mark_payment_delivered(payment_id, now):
+    """Record that the invite link for an approved payment reached the user."""
+    with write_transaction() as conn:
+        conn.execute("UPDATE payments SET delivered_at = ? WHERE id = ?", (now, payment_id))
+
+def approve_payment(payment_id, admin_id, now):
+    """Approve a pending payment and grant its subscription in one transaction.
+
+    The approving caller also holds the delivery claim for the invite link.
+    Returns (user_id, months, expiry), or None if the payment was not pending.
+    """
+    with write_transaction() as conn:
+        cur = conn.execute(
+            "UPDATE payments SET state = 'approved', decided_by = ?, decided_at = ?, "
+            "delivery_started_at = ? WHERE id = ? AND state = 'pending'",
+            (admin_id, now, now, payment_id),
+        )
+        if not cur.rowcount:
+            return None
+        user_id, months, amount = conn.execute(
+            "SELECT user_id, months, amount FROM payments WHERE id = ?", (payment_id,)
+        ).fetchone()
+        expiry = now + months * 30 * 86400
+        _put_subscriptions(conn, [(user_id, expiry)], now)
+        _record_stats(
+            conn, now,
+            counters=[("pending_payments", -1)],
+            daily=[("approvals", 1), ("revenue", amount or 0)],
+        )
+    _notify_listeners(user_id, expiry)
+    return user_id, months, expiry
+
+def decline_payment(payment_id, admin_id, now):
+    """Decline a pending payment. Returns False if it was already decided."""
+    with write_transaction() as conn:
+        cur = conn.execute(
+            "UPDATE payments SET state = 'declined', decided_by = ?, decided_at = ? "
+            "WHERE id = ? AND state = 'pending'",
+            (admin_id, now, payment_id),
+        )
+        if cur.rowcount:
+            _record_stats(conn, now, counters=[("pending_payments", -1)], daily=[("declines", 1)])
+    return cur.rowcount > 0
+
+# -------------------- Broadcasts --------------------
+# A broadcast walks the subscriptions table in user_id order. Its cursor and
+# counters are saved after every page, so a restart resumes where it stopped.
+BROADCAST_FIELDS = "id, created_by, created_at, text, audience, status, cursor, sent, failed, finished_at"
+
+def create_broadcast(created_by, text, audience, now):
+    with write_transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO broadcasts (created_by, created_at, text, audience) VALUES (?, ?, ?, ?)",
+            (created_by, now, text, audience),
+        )
+    return cur.lastrowid
+
+def get_running_broadcasts():
+    return read_connection().execute(
+        f"SELECT {BROADCAST_FIELDS} FROM broadcasts WHERE status = 'running' ORDER BY id"
+    ).fetchall()
+
+def get_recent_broadcasts(limit=5):
+    return read_connection().execute(
+        f"SELECT {BROADCAST_FIELDS} FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)
+    ).fetchall()
+
+def get_broadcast_status(broadcast_id):
+    row = read_connection().execute(
+        "SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def get_broadcast_recipients(audience, after_user_id, now, limit):
+    if audience == "active":
+        sql = "SELECT user_id FROM subscriptions WHERE user_id > ? AND expiry_date > ? ORDER BY user_id LIMIT ?"
+        params = (after_user_id, now, limit)
+    else:
+        sql = "SELECT user_id FROM subscriptions WHERE user_id > ? ORDER BY user_id LIMIT ?"
+        params = (after_user_id, limit)
+    return [row[0] for row in read_connection().execute(sql, params).fetchall()]
+
+def save_broadcast_progress(broadcast_id, cursor, sent, failed):
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE broadcasts SET cursor = ?, sent = sent + ?, failed = failed + ? WHERE id = ?",
+            (cursor, sent, failed, broadcast_id),
+        )
+
+def finish_broadcast(broadcast_id, status, now):
+    """Move a running broadcast to `status`. Returns False if it wasn't running."""
+    with write_transaction() as conn:
+        cur = conn.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+            (status, now, broadcast_id),
+        )
+    return cur.rowcount > 0
+
+# -------------------- Reminders --------------------
+def get_reminder_candidates(kind, window_start, window_end, after, limit):
+    """Subscriptions expiring in (window_start, window_end] not yet reminded for `kind`.
+
+    `after` is an (expiry_date, user_id) cursor so a sweep never revisits rows.
+    """
+    return read_connection().execute(
+        "SELECT user_id, expiry_date FROM subscriptions s "
+        "WHERE expiry_date > ? AND expiry_date <= ? AND (expiry_date, user_id) > (?, ?) "
+        "AND NOT EXISTS (SELECT 1 FROM reminders r "
+        "WHERE r.user_id = s.user_id AND r.expiry_date = s.expiry_date AND r.kind = ?) "
+        "ORDER BY expiry_date, user_id LIMIT ?",
+        (window_start, window_end, *after, kind, limit),
+    ).fetchall()
+
+def record_reminders(rows):
+    """Record (user_id, expiry_date, kind, sent_at) rows in one transaction."""
+    with write_transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO reminders VALUES (?, ?, ?, ?)", rows)
+
+def prune_reminders(expired_before):
+    with write_transaction() as conn:
+        conn.execute("DELETE FROM reminders WHERE expiry_date < ?", (expired_before,))
+
+# -------------------- Application Persistence --------------------
+# user_data/chat_data rows carry a seq that grows with every batch written by
+# any process, so each worker can tail the changes made by the others.
+def save_persistent_data(table, rows):
+    """REPLACE a batch of (id, json) rows in one transaction under a new seq."""
+    with write_transaction() as conn:
+        seq = conn.execute(f"SELECT COALESCE(MAX(seq), 0) + 1 FROM {table}").fetchone()[0]
+        conn.executemany(
+            f"REPLACE INTO {table} (id, data, seq) VALUES (?, ?, ?)",
+            [(key, data, seq) for key, data in rows],
+        )
+
+def load_persistent_data(table, key):
+    row = read_connection().execute(f"SELECT data FROM {table} WHERE id = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def load_persistent_changes(table, after, limit=1000):
+    """Rows written after the (seq, id) cursor `after`, in (seq, id) order.
+
+    One flush shares a single seq across all its rows, so paging on seq alone
+    would cut a large flush in half.
+    """
+    return read_connection().execute(
+        f"SELECT id, data, seq FROM {table} WHERE (seq, id) > (?, ?) ORDER BY seq, id LIMIT ?",
+        (*after, limit),
+    ).fetchall()
+
+def get_persistent_cursor(table):
+    """The (seq, id) of the last row written, or (0, 0) for an empty table."""
+    row = read_connection().execute(
+        f"SELECT seq, id FROM {table} ORDER BY seq DESC, id DESC LIMIT 1"
+    ).fetchone()
+    return tuple(row) if row else (0, 0)
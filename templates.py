@@ -0,0 +1,191 @@
+import os
+import json
+import logging
+from types import MappingProxyType
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+log = logging.getLogger(__name__)
+
+# -------------------- Plan Configuration --------------------
+# Plans and the payment account come from PLANS_FILE when it exists, e.g.
+#   {"telebirr_account": "0987973732",
+#    "plans": [{"months": 1, "price": 700, "emoji": "💎",
+#               "blurb": "Full access for 30 days", "blurb_am": "ለ30 ቀናት ሙሉ መዳረሻ"}]}
+# Only months and price are required for each plan.
+PLANS_FILE = os.getenv("PLANS_FILE", "plans.json")
+
+DEFAULT_CONFIG = {
+    "telebirr_account": os.getenv("TELEBIRR_ACCOUNT", "0987973732"),
+    "plans": [
+        {"months": 1, "price": 700, "emoji": "💎",
+         "blurb": "Full access for 30 days", "blurb_am": "ለ30 ቀናት ሙሉ መዳረሻ"},
+        {"months": 2, "price": 1400, "emoji": "✨",
+         "blurb": "Save more with longer access", "blurb_am": "በረጅም ጊዜ አባልነት የበለጠ ይቆጥቡ"},
+        {"months": 3, "price": 2000, "emoji": "🔥",
+         "blurb": "Best value, ultimate experience", "blurb_am": "ምርጥ ዋጋ፣ ምርጥ ተሞክሮ"},
+    ],
+}
+
+LANGUAGES = ("en", "am")
+
+def load_plan_config():
+    """Read PLANS_FILE, falling back to the built-in plans if it is missing."""
+    try:
+        with open(PLANS_FILE) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return DEFAULT_CONFIG
+    plans = config.get("plans")
+    if not plans:
+        raise ValueError(f"{PLANS_FILE} defines no plans")
+    for plan in plans:
+        if int(plan["months"]) < 1 or int(plan["price"]) < 1:
+            raise ValueError(f"Invalid plan in {PLANS_FILE}: {plan}")
+    config.setdefault("telebirr_account", DEFAULT_CONFIG["telebirr_account"])
+    return config
+
+def plans_file_mtime():
+    try:
+        return os.stat(PLANS_FILE).st_mtime
+    except OSError:
+        return None
+
+def user_language(user):
+    """'am' for users whose Telegram client is set to Amharic, else 'en'."""
+    code = getattr(user, "language_code", None) or ""
+    return "am" if code.startswith("am") else "en"
+
+# -------------------- Funnel Templates --------------------
+RULE = "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+
+WELCOME_BODY = (
+    "╔══════════════════════════════╗\n"
+    "     👑🔥 **VVIP HABESHA** 🔥👑     \n"
+    "╚══════════════════════════════╝\n\n"
+    "✨ *Welcome to the most exclusive Habesha premium channel!* ✨\n\n"
+    + RULE +
+    "🇺🇸 **What you'll enjoy:**\n"
+    "• 🔥 Exclusive hot videos & photos\n"
+    "• 📅 Daily premium content updates\n"
+    "• 🎥🔴 Live streaming every night\n"
+    "• 💃🏾 Sexy live performances\n"
+    "• 💬 Direct interaction with the community\n"
+    "• 🕒 24/7 VIP support\n\n"
+    "🇪🇹 **ምን ያገኛሉ:**\n"
+    "• 🔥 ልዩ ሙቅ ቪዲዮዎች እና ፎቶዎች\n"
+    "• 📅 ዕለታዊ አዲስ ፕሪሚየም ኮንቴንት\n"
+    "• 🔴 በየምሽቱ ቀጥታ ስርጭት\n"
+    "• 💃🏾 ሴክሲ የቀጥታ ትዕይንቶች\n"
+    "• 💬 ቀጥተኛ ውይይት በፕራይቬት ቻናል\n"
+    "• 🕒 24/7 ድጋፍ\n"
+    + RULE + "\n"
+)
+
+STRINGS = {
+    "en": {
+        "choose_below": "👇 *Choose your membership plan below* 👇",
+        "proceed_button": "💳 Proceed to Membership",
+        "select_plan": "🌟 **Select your VIP plan** 🌟\n\n",
+        "tap_button": "Tap a button below to continue:",
+        "month": "Month", "months": "Months",
+        "currency": "Birr",
+        "selected": "✅ **You selected {months} month(s)**\n💵 **Total: {price} Birr**\n\n",
+        "choose_first": (
+            "⚠️ Please first choose a subscription plan using /start.\n\n"
+            "👉 Tap the button below to begin."
+        ),
+    },
+    "am": {
+        "choose_below": "👇 *ከታች የአባልነት እቅድዎን ይምረጡ* 👇",
+        "proceed_button": "💳 ወደ አባልነት ይቀጥሉ",
+        "select_plan": "🌟 **የቪአይፒ እቅድዎን ይምረጡ** 🌟\n\n",
+        "tap_button": "ለመቀጠል ከታች ያለውን ቁልፍ ይጫኑ:",
+        "month": "ወር", "months": "ወር",
+        "currency": "ብር",
+        "selected": "✅ **{months} ወር መርጠዋል**\n💵 **ጠቅላላ: {price} ብር**\n\n",
+        "choose_first": (
+            "⚠️ እባክዎ መጀመሪያ /start በመጠቀም የአባልነት እቅድ ይምረጡ።\n\n"
+            "👉 ለመጀመር ከታች ያለውን ቁልፍ ይጫኑ።"
+        ),
+    },
+}
+
+class FunnelTemplates:
+    """Ready-to-send texts and keyboards for one plan configuration.
+
+    Everything is rendered once here; handlers only look payloads up. The
+    keyboards are frozen TelegramObjects and the lookup tables are read-only
+    views, so one instance can be shared by every concurrent handler.
+    """
+
+    def __init__(self, config):
+        plans = sorted(config["plans"], key=lambda plan: int(plan["months"]))
+        self.account = config["telebirr_account"]
+        self.prices = MappingProxyType({int(p["months"]): int(p["price"]) for p in plans})
+        welcome, proceed, plans_text, plan_keyboard, payment, choose_first = {}, {}, {}, {}, {}, {}
+        for lang in LANGUAGES:
+            s = STRINGS[lang]
+            welcome[lang] = WELCOME_BODY + s["choose_below"]
+            proceed[lang] = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(s["proceed_button"], callback_data="proceed")]]
+            )
+            plan_keyboard[lang] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(
+                    f"{p.get('emoji', '💎')} {p['months']} {s['month'] if int(p['months']) == 1 else s['months']}"
+                    f" – {p['price']} {s['currency']}",
+                    callback_data=f"plan:{p['months']}",
+                )]
+                for p in plans
+            ])
+            lines = []
+            for p in plans:
+                unit = s["month"] if int(p["months"]) == 1 else s["months"]
+                blurb = p.get("blurb_am" if lang == "am" else "blurb") or p.get("blurb")
+                line = f"{p.get('emoji', '💎')} **{p['months']} {unit}**"
+                lines.append(f"{line} – {blurb}\n" if blurb else line + "\n")
+            plans_text[lang] = s["select_plan"] + RULE + "".join(lines) + RULE + "\n" + s["tap_button"]
+            for months, price in self.prices.items():
+                payment[months, lang] = self._payment_text(lang, months, price)
+            choose_first[lang] = s["choose_first"]
+        self.welcome = MappingProxyType(welcome)
+        self.proceed_keyboard = MappingProxyType(proceed)
+        self.plans_text = MappingProxyType(plans_text)
+        self.plan_keyboard = MappingProxyType(plan_keyboard)
+        self.payment_text = MappingProxyType(payment)
+        self.choose_plan_first = MappingProxyType(choose_first)
+
+    def _payment_text(self, lang, months, price):
+        english = (
+            f"🇺🇸 *Please send exactly **{price} Birr** to the following Telebirr account:*\n"
+            f"`{self.account}`\n\n"
+            "📸 *After payment, send a screenshot of the transaction.*\n\n"
+        )
+        amharic = (
+            f"🇪🇹 *እባክዎ በትክክል **{price} ብር** ወደዚህ ቴሌብር አካውንት ይላኩ።*\n"
+            f"`{self.account}`\n\n"
+            "*ከክፍያ በኋላ የስክሪን ሾት ይላኩ።*\n"
+        )
+        body = amharic + "\n" + english if lang == "am" else english + amharic
+        return STRINGS[lang]["selected"].format(months=months, price=price) + RULE + body + RULE.rstrip("\n")
+
+# -------------------- Registry --------------------
+# Handlers always read the module-level instance, so a reload swaps every
+# payload at once; a bad config leaves the previous one in place.
+current = FunnelTemplates(load_plan_config())
+loaded_mtime = plans_file_mtime()
+
+def reload_templates():
+    """Rebuild the templates from PLANS_FILE. Returns the new instance."""
+    global current, loaded_mtime
+    mtime = plans_file_mtime()
+    templates = FunnelTemplates(load_plan_config())
+    current, loaded_mtime = templates, mtime
+    log.info("Plan templates loaded", extra={"prices": dict(templates.prices)})
+    return templates
+
+def reload_if_changed():
+    """Reload when PLANS_FILE was created, edited or removed since the last load."""
+    if plans_file_mtime() != loaded_mtime:
+        reload_templates()
+        return True
+    return False
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# storage reads DB_PATH at import time, so every test module shares one
+# scratch database set up here, before any of them imports it.
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,242 @@
+import asyncio
+import itertools
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from telegram import Update
+
+import botapi
+from bench.fake_bot_api import FakeBotAPI, serve
+
+ADMIN_ID = 42
+_ids = itertools.count(1)
+
+class RecordingBotAPI(FakeBotAPI):
+    """Fake Bot API that keeps every sendMessage and can fail chosen methods."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.messages = []
+        self.failing = set()
+        self.flooding = {}
+
+    def handle(self, method, params):
+        if method in self.flooding:
+            self.record(method, True)
+            retry_after = self.flooding[method]
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }
+        if method in self.failing:
+            self.record(method, False)
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        code, payload = super().handle(method, params)
+        if method == "sendMessage":
+            self.messages.append((int(params["chat_id"]), params.get("text", "")))
+        return code, payload
+
+    def messages_to(self, chat_id):
+        return [text for chat, text in self.messages if chat == chat_id]
+
+api = bot = storage = None
+
+def setUpModule():
+    # bot.py starts its event loop and initializes against the Bot API on
+    # import, so the fake API has to be up and configured first.
+    global api, bot, storage
+    # Enough latency that two clicks on the same button overlap.
+    api = RecordingBotAPI(latency=0.05)
+    server = serve(api, port=0)
+    os.environ.update(
+        BOT_TOKEN="123456:TEST",
+        PRIVATE_CHANNEL_ID="-1001000000000",
+        ADMIN_IDS=str(ADMIN_ID),
+        BOT_IDENTITY_CACHE=os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "bot_identity.json"),
+        TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/bot",
+        WEBHOOK_MODE="sync",
+    )
+    import bot as bot_module
+    import storage as storage_module
+    bot, storage = bot_module, storage_module
+    bot.app_ready.result(timeout=30)
+
+def run(coro):
+    return bot.run_on_bot_loop(coro, 30)
+
+def context():
+    return SimpleNamespace(bot=bot.application.bot, application=bot.application, user_data={})
+
+def admin_click(data):
+    """A callback update for an admin pressing a button on a payment photo."""
+    return Update.de_json({
+        "update_id": next(_ids),
+        "callback_query": {
+            "id": str(next(_ids)),
+            "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"},
+            "chat_instance": "1",
+            "data": data,
+            "message": {
+                "message_id": next(_ids),
+                "date": int(time.time()),
+                "chat": {"id": ADMIN_ID, "type": "private"},
+                "photo": [{"file_id": "proof", "file_unique_id": "proof", "width": 1, "height": 1}],
+                "caption": "payment",
+            },
+        },
+    }, bot.application.bot)
+
+def user_photo(user_id, file_unique_id):
+    """A message update for a user sending a payment screenshot."""
+    return Update.de_json({
+        "update_id": next(_ids),
+        "message": {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "photo": [{"file_id": "file-" + file_unique_id, "file_unique_id": file_unique_id, "width": 1, "height": 1}],
+        },
+    }, bot.application.bot)
+
+def admin_command(text):
+    return Update.de_json({
+        "update_id": next(_ids),
+        "message": {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": {"id": ADMIN_ID, "type": "private"},
+            "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"},
+            "text": text,
+        },
+    }, bot.application.bot)
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for the bot")
+        time.sleep(0.02)
+
+def issued_links(user_id):
+    return storage.read_connection().execute(
+        "SELECT COUNT(*) FROM invite_links WHERE user_id = ?", (user_id,)
+    ).fetchone()[0]
+
+class ApprovalTests(unittest.TestCase):
+    def setUp(self):
+        api.failing.clear()
+
+    def test_double_click_sends_one_invite(self):
+        payment_id, _ = storage.record_payment("bot-double", 555, 1, 700, int(time.time()))
+        data = f"approve:555:1:{payment_id}"
+
+        async def clicks():
+            await asyncio.gather(*(bot.handle_callback(admin_click(data), context()) for _ in range(2)))
+
+        run(clicks())
+        self.assertEqual(len(api.messages_to(555)), 1)
+        self.assertEqual(issued_links(555), 1)
+        state, delivered_at = storage.get_payment_status(payment_id)
+        self.assertEqual(state, "approved")
+        self.assertIsNotNone(delivered_at)
+
+    def test_failed_delivery_can_be_resent(self):
+        payment_id, _ = storage.record_payment("bot-resend", 556, 2, 1400, int(time.time()))
+        data = f"approve:556:2:{payment_id}"
+        api.failing.add("sendMessage")
+        run(bot.handle_callback(admin_click(data), context()))
+        self.assertEqual(storage.get_payment_status(payment_id), ("approved", None))
+        expiry = storage.get_subscription_expiry(556)
+
+        api.failing.clear()
+        run(bot.handle_callback(admin_click(data), context()))
+        self.assertEqual(len(api.messages_to(556)), 1)
+        self.assertIsNotNone(storage.get_payment_status(payment_id)[1])
+        # The resend doesn't extend the subscription again.
+        self.assertEqual(storage.get_subscription_expiry(556), expiry)
+
+class PaymentForwardTests(unittest.TestCase):
+    def setUp(self):
+        api.failing.clear()
+
+    def test_payment_no_admin_received_can_be_resent(self):
+        user_data = {"selected_months": 1}
+        ctx = SimpleNamespace(bot=bot.application.bot, application=bot.application, user_data=user_data)
+        api.failing.add("sendPhoto")
+        run(bot.handle_photo(user_photo(557, "bot-unseen"), ctx))
+        wait_for(lambda: len(api.messages_to(557)) == 2)
+        self.assertTrue(any("couldn't reach the admins" in text for text in api.messages_to(557)))
+        self.assertEqual(user_data, {"selected_months": 1})
+
+        api.failing.clear()
+        photos = api.stats()["calls"].get("sendPhoto", 0)
+        run(bot.handle_photo(user_photo(557, "bot-unseen"), ctx))
+        wait_for(lambda: api.stats()["calls"].get("sendPhoto", 0) > photos)
+        self.assertIn("forwarded to our admins", api.messages_to(557)[-1])
+        payment_id, state = storage.record_payment("bot-unseen", 557, 1, 700, int(time.time()))
+        self.assertEqual(state, "pending")
+
+class AdminCommandTests(unittest.TestCase):
+    def setUp(self):
+        api.failing.clear()
+
+    def test_export_small_table(self):
+        storage.add_subscriptions([(user_id, 30) for user_id in range(900, 910)])
+        documents = api.stats()["calls"].get("sendDocument", 0)
+        run(bot.export_subscriptions(admin_command("/export"), context()))
+        self.assertEqual(api.stats()["calls"].get("sendDocument", 0), documents + 1)
+
+    def test_approve_rejects_space_separated_ids(self):
+        ctx = SimpleNamespace(bot=bot.application.bot, args=["920", "6", "921"])
+        run(bot.approve_manual(admin_command("/approve 920 6 921"), ctx))
+        self.assertIn("Usage: /approve", api.messages_to(ADMIN_ID)[-1])
+        self.assertIsNone(storage.get_subscription_expiry(920))
+        self.assertIsNone(storage.get_subscription_expiry(921))
+
+    def test_broadcast_cancel_without_id_is_not_broadcast(self):
+        for text in ("/broadcast cancel", "/broadcast cancel 7x"):
+            ctx = SimpleNamespace(bot=bot.application.bot, args=text.split()[1:])
+            run(bot.broadcast_command(admin_command(text), ctx))
+            self.assertEqual(api.messages_to(ADMIN_ID)[-1], "Usage: /broadcast cancel <id>")
+        self.assertEqual(storage.get_running_broadcasts(), [])
+
+class FloodTests(unittest.TestCase):
+    def tearDown(self):
+        api.flooding.clear()
+        # Don't leave the shared bucket paused for the other tests.
+        bot.api_bucket._paused_until = 0.0
+
+    def test_long_flood_pauses_bucket_and_reschedules_expiry(self):
+        retry_after = int(botapi.BOT_API_MAX_RETRY_AFTER) + 5
+        api.flooding["banChatMember"] = retry_after
+        started = time.time()
+        self.assertFalse(run(bot.expire_user(930, asyncio.Semaphore(1))))
+        self.assertGreater(bot.api_bucket._paused_until, time.monotonic() + retry_after - 5)
+        with bot._expiry_lock:
+            self.assertGreaterEqual(bot._expiry_due[930], started + retry_after)
+
+    def test_bulk_messages_wait_out_flood_control(self):
+        # Raise every 429 to the caller instead of retrying in the request layer.
+        api.flooding["sendMessage"] = 1
+        threading.Timer(1.5, api.flooding.clear).start()
+        recipients = list(range(940, 945))
+
+        async def send_all():
+            semaphore = asyncio.Semaphore(len(recipients))
+            return await asyncio.gather(*(bot.send_bulk_message(user_id, "news", semaphore) for user_id in recipients))
+
+        with mock.patch.object(botapi, "BOT_API_MAX_RETRY_AFTER", 0):
+            self.assertEqual(run(send_all()), [True] * len(recipients))
+        for user_id in recipients:
+            self.assertEqual(api.messages_to(user_id), ["news"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+
+import storage
+
+THREADS = 16
+
+def run_concurrently(func, *args_per_thread):
+    """Start func(*args) on one thread per args tuple at the same moment."""
+    barrier = threading.Barrier(len(args_per_thread))
+    results = [None] * len(args_per_thread)
+
+    def worker(i, args):
+        barrier.wait()
+        results[i] = func(*args)
+
+    threads = [threading.Thread(target=worker, args=(i, args)) for i, args in enumerate(args_per_thread)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class PaymentTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        storage.init_db()
+
+    def setUp(self):
+        self.now = int(time.time())
+
+    def test_same_screenshot_is_one_payment(self):
+        payment_id, state = storage.record_payment("shot-dup", 101, 1, 700, self.now)
+        self.assertIsNone(state)
+        self.assertEqual(storage.record_payment("shot-dup", 101, 1, 700, self.now), (payment_id, "pending"))
+        # Another user forwarding the same image gets the existing payment too.
+        self.assertEqual(storage.record_payment("shot-dup", 202, 2, 1400, self.now), (payment_id, "pending"))
+
+    def test_concurrent_submissions_create_one_payment(self):
+        results = run_concurrently(
+            storage.record_payment, *[("shot-race", 303, 1, 700, self.now)] * THREADS
+        )
+        self.assertEqual(len({payment_id for payment_id, _ in results}), 1)
+        self.assertEqual(sum(state is None for _, state in results), 1)
+
+    def test_concurrent_approvals_apply_once(self):
+        payment_id, _ = storage.record_payment("shot-approve", 404, 2, 1400, self.now)
+        results = run_concurrently(
+            storage.approve_payment, *[(payment_id, admin_id, self.now) for admin_id in range(THREADS)]
+        )
+        granted = [result for result in results if result is not None]
+        self.assertEqual(len(granted), 1)
+        self.assertEqual(granted[0], (404, 2, self.now + 60 * 86400))
+        self.assertEqual(storage.get_subscription_expiry(404), self.now + 60 * 86400)
+        self.assertEqual(storage.get_payment_status(payment_id), ("approved", None))
+        self.assertFalse(storage.decline_payment(payment_id, 1, self.now))
+
+    def test_concurrent_approve_and_decline_pick_one(self):
+        payment_id, _ = storage.record_payment("shot-mixed", 505, 1, 700, self.now)
+        calls = [(storage.approve_payment if i % 2 else storage.decline_payment, payment_id, i, self.now)
+                 for i in range(THREADS)]
+        results = run_concurrently(lambda func, *args: (func, func(*args)), *calls)
+        winners = [func for func, result in results if result not in (None, False)]
+        self.assertEqual(len(winners), 1)
+        state, _ = storage.get_payment_status(payment_id)
+        self.assertEqual(state, "approved" if winners[0] is storage.approve_payment else "declined")
+
+    def test_delivery_is_claimed_once(self):
+        payment_id, _ = storage.record_payment("shot-claim", 707, 1, 700, self.now)
+        storage.approve_payment(payment_id, 1, self.now)
+        # The approver holds the claim until it goes stale or is released.
+        self.assertFalse(storage.claim_payment_delivery(payment_id, self.now, self.now - 120))
+        storage.release_payment_delivery(payment_id)
+        results = run_concurrently(
+            storage.claim_payment_delivery, *[(payment_id, self.now, self.now - 120)] * THREADS
+        )
+        self.assertEqual(results.count(True), 1)
+        storage.mark_payment_delivered(payment_id, self.now)
+        self.assertFalse(storage.claim_payment_delivery(payment_id, self.now + 999, self.now + 999))
+
+    def test_decisions_update_stats_once(self):
+        before, _ = storage.get_stats(storage.stats_day(self.now))
+        payment_id, _ = storage.record_payment("shot-stats", 606, 1, 700, self.now)
+        run_concurrently(storage.decline_payment, *[(payment_id, i, self.now) for i in range(THREADS)])
+        after, _ = storage.get_stats(storage.stats_day(self.now))
+        self.assertEqual(after["pending_payments"], before.get("pending_payments", 0))
+
+if __name__ == "__main__":
+    unittest.main()